@@ -0,0 +1,161 @@
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import platform
+import argparse
+import tempfile
+import subprocess
+
+from .library import generate_library
+
+# repo root, so workers import this checkout's nyxbot
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _git_commit():
+    """Gets the commit being benchmarked, if we're in a git checkout"""
+
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=ROOT, check=True, capture_output=True, text=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_size(size: int, args, fuzzy_size: int = 0):
+    """
+    Generates a library of a given size and benchmarks it, along with
+    the fuzzy index at fuzzy_size rows if given
+    """
+
+    workdir = tempfile.mkdtemp(prefix=f"nyxbot-bench-{size}-", dir=args.workdir)
+    try:
+
+        # write the library
+        music_path = os.path.join(workdir, "music")
+        config_path = os.path.join(workdir, "config")
+        os.makedirs(config_path)
+        start = time.perf_counter()
+        generate_library(music_path, size, args.seed)
+        generate_seconds = time.perf_counter() - start
+        print(f"Generated {size} tracks in {generate_seconds:.1f}s", file=sys.stderr)
+
+        # benchmark it in a fresh interpreter pointed at it
+        output = os.path.join(workdir, "results.json")
+        env = dict(
+            os.environ,
+            CONFIG_PATH=config_path,
+            MUSIC_PATH=music_path,
+            DISCORD_CHANNEL='0',
+            OPUS_CACHE_SIZE='0',
+            SEARCH_CACHE_SIZE='0',
+            PYTHONPATH=ROOT,
+        )
+        subprocess.run(
+            [
+                sys.executable, '-m', 'benchmarks.run',
+                '--size', str(size), '--seed', str(args.seed),
+                '--repeat', str(args.repeat), '--output', output,
+                '--fuzzy-size', str(fuzzy_size)
+            ],
+            env=env, cwd=ROOT, check=True
+        )
+        with open(output) as f:
+            results = json.load(f)
+
+        return {
+            "size": size,
+            "generate_seconds": generate_seconds,
+            "benchmarks": results,
+        }
+
+    # clean up, unless asked not to
+    finally:
+        if args.keep:
+            print(f"Kept library at {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+def compare(baseline: dict, current: dict):
+    """Prints how each benchmark moved against a baseline run"""
+
+    # time per operation, keyed by size and benchmark
+    def per_op(run):
+        return {
+            (result["size"], name): bench["seconds"] / bench["count"]
+            for result in run["results"]
+            for name, bench in result["benchmarks"].items() if bench["count"]
+        }
+    old, new = per_op(baseline), per_op(current)
+
+    # print anything in both, slower first
+    rows = sorted(
+        ((new[key] / old[key], key) for key in new if key in old and old[key]),
+        reverse=True
+    )
+    print(f"{'size':>9}  {'benchmark':<28} {'change':>8}")
+    for ratio, (size, name) in rows:
+        print(f"{size:>9}  {name:<28} {(ratio - 1) * 100:>+7.1f}%")
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description="Benchmarks indexing, search and queue operations " + \
+            "against synthetic libraries"
+    )
+    parser.add_argument('--sizes', default="1000",
+        help="comma separated library sizes, e.g. 1000,100000,1000000")
+    parser.add_argument('--seed', type=int, default=0,
+        help="seed for the generated library and queries")
+    parser.add_argument('--repeat', type=int, default=5,
+        help="rounds of each search query")
+    parser.add_argument('--fuzzy-size', type=int, default=400000,
+        help="rows in the in-memory fuzzy index benchmark, run once, 0 to skip")
+    parser.add_argument('--workdir', default=None,
+        help="where libraries are generated, defaults to the temp dir")
+    parser.add_argument('--keep', action='store_true',
+        help="keep generated libraries")
+    parser.add_argument('-o', '--output', default=None,
+        help="file to write json results to, defaults to stdout")
+    parser.add_argument('--compare', default=None,
+        help="json results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    # run every size
+    run = {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "index_workers": os.getenv('INDEX_WORKERS'),
+            "seed": args.seed,
+            "repeat": args.repeat,
+            "fuzzy_size": args.fuzzy_size,
+        },
+        "results": [
+            run_size(int(size), args, args.fuzzy_size if i == 0 else 0)
+            for i, size in enumerate(args.sizes.split(","))
+        ],
+    }
+
+    # write results
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(run, f, indent=2)
+    else:
+        json.dump(run, sys.stdout, indent=2)
+        print()
+
+    # compare, if asked
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), run)
+
+if __name__ == '__main__':
+    sys.exit(main())
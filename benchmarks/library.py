@@ -0,0 +1,186 @@
+import os
+import random
+import struct
+
+# tracks per album, and albums per artist
+TRACKS_PER_ALBUM = 10
+ALBUMS_PER_ARTIST = 5
+
+# formats written, round robin
+FORMATS = ("mp3", "flac", "wav")
+
+# syllables made up words are built from
+SYLLABLES = (
+    "ka", "lo", "mi", "ne", "ru", "sa", "to", "vi", "zen", "dra",
+    "bel", "cor", "fa", "gri", "hu", "jo", "lux", "mor", "pa", "quin",
+)
+
+# real titles lean on a handful of words, which makes their trigrams
+# far commoner than made up words' are; roughly most common first
+COMMON_WORDS = (
+    "the", "love", "you", "me", "my", "of", "in", "a", "to", "and",
+    "song", "night", "heart", "baby", "time", "girl", "dance", "blue",
+    "little", "all", "your", "on", "it", "for", "down", "home", "life",
+    "world", "day", "man", "rain", "dream", "fire", "light", "away",
+)
+
+# chance each word of a generated title is a common one
+COMMON_SHARE = 0.3
+
+def make_words(rng: random.Random, count: int):
+    """Makes up a vocabulary of distinct words"""
+
+    words = set()
+    while len(words) < count:
+        words.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+def _id3_frame(frame_id: str, text: str):
+    """Builds an ID3v2.3 text frame"""
+
+    data = b'\x03' + text.encode('utf-8')
+    return frame_id.encode('ascii') + struct.pack('>IH', len(data), 0) + data
+
+def _syncsafe(size: int):
+    """Encodes a size as an ID3 syncsafe integer"""
+
+    return bytes((size >> shift) & 0x7F for shift in (21, 14, 7, 0))
+
+def id3_tag(tags: dict):
+    """Builds an ID3v2.3 tag from a dict of title, artist, album, track and disc"""
+
+    frames = b''.join((
+        _id3_frame('TIT2', tags['title']),
+        _id3_frame('TPE1', tags['artist']),
+        _id3_frame('TALB', tags['album']),
+        _id3_frame('TRCK', str(tags['track'])),
+        _id3_frame('TPOS', str(tags['disc'])),
+    ))
+    return b'ID3\x03\x00\x00' + _syncsafe(len(frames)) + frames
+
+def mp3_bytes(tags: dict):
+    """Builds a tagged mp3 holding a few silent mpeg frames"""
+
+    # mpeg 1 layer iii, 128kbps, 44.1kHz; 417 bytes per frame
+    frame = b'\xff\xfb\x90\x64' + bytes(413)
+    return id3_tag(tags) + frame * 4
+
+def flac_bytes(tags: dict):
+    """Builds a tagged flac holding just its metadata"""
+
+    # streaminfo: block sizes, frame sizes, then 44.1kHz, stereo,
+    # 16 bit, one second of samples, and an empty md5
+    info = struct.pack('>HH', 4096, 4096) + bytes(6) + \
+        ((44100 << 44) | (1 << 41) | (15 << 36) | 44100).to_bytes(8, 'big') + \
+        bytes(16)
+
+    # vorbis comment, little endian lengths
+    comments = [
+        f"TITLE={tags['title']}", f"ARTIST={tags['artist']}",
+        f"ALBUM={tags['album']}", f"TRACKNUMBER={tags['track']}",
+        f"DISCNUMBER={tags['disc']}",
+    ]
+    vendor = b'nyxbot-benchmarks'
+    comment = struct.pack('<I', len(vendor)) + vendor + \
+        struct.pack('<I', len(comments)) + b''.join(
+            struct.pack('<I', len(c.encode('utf-8'))) + c.encode('utf-8')
+            for c in comments
+        )
+
+    # block headers: type and last flag, then a 24 bit length
+    return b'fLaC' + \
+        bytes((0,)) + len(info).to_bytes(3, 'big') + info + \
+        bytes((0x84,)) + len(comment).to_bytes(3, 'big') + comment
+
+def wav_bytes(tags: dict):
+    """Builds a wav holding a moment of silence, tagged with an id3 chunk"""
+
+    # 16 bit stereo at 44.1kHz, 10ms of samples
+    fmt = struct.pack('<HHIIHH', 1, 2, 44100, 44100 * 4, 4, 16)
+    data = bytes(441 * 4)
+    tag = id3_tag(tags)
+    if len(tag) % 2:
+        tag += b'\x00'
+
+    chunks = b'fmt ' + struct.pack('<I', len(fmt)) + fmt + \
+        b'data' + struct.pack('<I', len(data)) + data + \
+        b'id3 ' + struct.pack('<I', len(tag)) + tag
+    return b'RIFF' + struct.pack('<I', 4 + len(chunks)) + b'WAVE' + chunks
+
+WRITERS = {
+    "mp3": mp3_bytes,
+    "flac": flac_bytes,
+    "wav": wav_bytes,
+}
+
+def generate_library(root: str, tracks: int, seed: int = 0):
+    """
+    Writes a synthetic library of tiny tagged files under root, laid out
+    as artist/album/track, deterministically for a given seed
+    Returns: List of (path, tags) for every track written
+    """
+
+    # enough words for every artist, album and title to be distinctive
+    rng = random.Random(seed)
+    words = make_words(rng, max(200, int(tracks ** 0.5) * 4))
+
+    library = []
+    for i in range(tracks):
+
+        # position of this track in the library
+        album_index = i // TRACKS_PER_ALBUM
+        artist_index = album_index // ALBUMS_PER_ARTIST
+        track = i % TRACKS_PER_ALBUM + 1
+
+        # names are seeded by their position, so they're stable across
+        # library sizes
+        artist = " ".join(random.Random(f"{seed}-artist-{artist_index}").sample(words, 2)).title()
+        album = " ".join(random.Random(f"{seed}-album-{album_index}").sample(words, 2)).title()
+        title = " ".join(rng.sample(words, rng.randint(1, 4))).title()
+        tags = {
+            "title": title,
+            "artist": artist,
+            "album": album,
+            "track": track,
+            "disc": 1,
+        }
+
+        # write it
+        ext = FORMATS[i % len(FORMATS)]
+        folder = os.path.join(
+            root, f"{artist_index:05d} {artist}", f"{album_index:06d} {album}"
+        )
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"{track:02d} {title}.{ext}")
+        with open(path, 'wb') as f:
+            f.write(WRITERS[ext](tags))
+        library.append((path, tags))
+
+    return library
+
+def generate_rows(count: int, seed: int = 0):
+    """
+    Makes up (id, title, artist) rows like a large library's, without
+    writing any files; for benchmarking the fuzzy index on its own
+    Returns: List of rows
+    """
+
+    rng = random.Random(seed)
+    words = make_words(rng, max(200, int(count ** 0.5) * 4))
+    artists = [
+        " ".join(rng.sample(words, 2)).title()
+        for _ in range(max(1, count // (TRACKS_PER_ALBUM * ALBUMS_PER_ARTIST)))
+    ]
+
+    # common words follow a rough zipf curve
+    weights = [1 / rank for rank in range(1, len(COMMON_WORDS) + 1)]
+
+    rows = []
+    for i in range(count):
+        title = " ".join(
+            rng.choices(COMMON_WORDS, weights)[0] if rng.random() < COMMON_SHARE
+                else rng.choice(words)
+            for _ in range(rng.randint(1, 5))
+        ).title()
+        rows.append((i + 1, title, artists[i // (TRACKS_PER_ALBUM * ALBUMS_PER_ARTIST)]))
+    return rows
@@ -0,0 +1,219 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import statistics
+
+# run by __main__ in a fresh interpreter per library size, since nyxbot
+# reads its paths from the environment on import
+
+# fraction of files touched before the change-aware rescan
+CHANGED_FRACTION = 0.01
+
+# searches run per query kind, and pages read from the queue
+QUERIES_PER_KIND = 50
+QUEUE_PAGES = 1000
+QUEUE_REMOVES = 100
+
+def timed(func, *args, count: int = 1):
+    """
+    Runs a function once, timing it
+    Returns: Tuple of its return value and a result dict
+    """
+
+    start = time.perf_counter()
+    value = func(*args)
+    seconds = time.perf_counter() - start
+    return value, {
+        "seconds": seconds,
+        "count": count,
+        "per_second": count / seconds if seconds else None,
+    }
+
+def latencies(samples: list):
+    """Summarizes a list of per call timings, in seconds"""
+
+    samples = sorted(samples)
+    return {
+        "seconds": sum(samples),
+        "count": len(samples),
+        "per_second": len(samples) / sum(samples) if sum(samples) else None,
+        "mean_ms": statistics.mean(samples) * 1000,
+        "p50_ms": samples[len(samples) // 2] * 1000,
+        "p95_ms": samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000,
+    }
+
+def _typo(rng: random.Random, word: str):
+    """Swaps two neighbouring letters in a word"""
+
+    if len(word) < 3:
+        return word
+    i = rng.randrange(len(word) - 1)
+    return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+
+def make_queries(rng: random.Random, rows: list):
+    """Makes a fixed set of queries of each kind from library rows"""
+
+    queries = {"exact": [], "artist_title": [], "prefix": [], "typo": [], "miss": []}
+    for row in rng.sample(rows, min(QUERIES_PER_KIND, len(rows))):
+        word = rng.choice(row['title'].split())
+        queries["exact"].append(row['title'])
+        queries["artist_title"].append(f"{row['artist']} {row['title']}")
+        queries["prefix"].append(word[:3])
+        queries["typo"].append(_typo(rng, word.lower()))
+        queries["miss"].append("qwx" + word.lower()[::-1])
+    return queries
+
+def bench_db(results: dict, seed: int, repeat: int):
+    """Times indexing, rescanning and searching the library"""
+
+    from nyxbot.env import env
+    from nyxbot import db
+
+    # create a fresh database
+    db.validate_config()
+
+    # walk the library
+    found, failed = {}, []
+    _, results["scan_dir"] = timed(db._scan_dir, env.music_path, found, failed)
+    results["scan_dir"]["count"] = len(found)
+
+    # index everything, cold
+    _, results["add_files_to_db"] = timed(
+        db.add_files_to_db, list(found), count=len(found)
+    )
+
+    # load the fuzzy index, as on startup
+    _, results["load_search_index"] = timed(db.load_search_index, count=len(found))
+
+    # rescan with nothing changed
+    _, results["poll_new_files.unchanged"] = timed(db.poll_new_files, count=len(found))
+
+    # rescan after touching some files
+    rng = random.Random(seed)
+    touched = rng.sample(sorted(found), max(1, int(len(found) * CHANGED_FRACTION)))
+    for path in touched:
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    result, results["poll_new_files.changed"] = timed(db.poll_new_files, count=len(found))
+    results["poll_new_files.changed"]["updated"] = result.updated
+
+    # search, a few rounds of every kind of query
+    with db._get_db_conn() as conn:
+        rows = [dict(row) for row in conn.execute('SELECT title, artist FROM library;')]
+    for kind, queries in make_queries(rng, rows).items():
+        samples = []
+        for _ in range(repeat):
+            for query in queries:
+                start = time.perf_counter()
+                db.search_db(query)
+                samples.append(time.perf_counter() - start)
+        results[f"search_db.{kind}"] = latencies(samples)
+
+def bench_fuzzy(results: dict, size: int, seed: int, repeat: int):
+    """
+    Times the fuzzy index on its own at a large library's size, with
+    the common words real titles share
+    """
+
+    from nyxbot.search import TrigramIndex
+    from .library import generate_rows, COMMON_WORDS
+
+    # build it
+    rows = generate_rows(size, seed)
+    index = TrigramIndex()
+    _, results["fuzzy.rebuild"] = timed(index.rebuild, rows, count=size)
+
+    # typo queries are what reach it in practice; common word ones hit
+    # the longest posting lists
+    rng = random.Random(seed)
+    queries = make_queries(rng, [{"title": row[1], "artist": row[2]} for row in rows])
+    queries["common"] = [
+        " ".join(rng.sample(COMMON_WORDS[:10], rng.randint(2, 5)))
+        for _ in range(QUERIES_PER_KIND)
+    ]
+    for kind in ("typo", "artist_title", "common"):
+        samples = []
+        for _ in range(repeat):
+            for query in queries[kind]:
+                start = time.perf_counter()
+                index.search(query, 18)
+                samples.append(time.perf_counter() - start)
+        results[f"fuzzy.{kind}"] = latencies(samples)
+
+def bench_queue(results: dict, size: int, seed: int):
+    """Times SongQueue operations on a queue as long as the library"""
+
+    from nyxbot.player import SongQueue
+
+    async def run():
+        rng = random.Random(seed)
+        queue = SongQueue()
+        entries = [{"id": i} for i in range(size)]
+
+        # fill it
+        def fill():
+            for entry in entries:
+                queue.put_nowait(entry)
+        _, results["queue.put"] = timed(fill, count=size)
+
+        # walk it, as the queue command would
+        _, results["queue.iterate"] = timed(lambda: sum(1 for _ in queue), count=size)
+
+        # read pages out of it
+        starts = [rng.randrange(size) for _ in range(QUEUE_PAGES)]
+        _, results["queue.page"] = timed(
+            lambda: [queue[i:i + 10] for i in starts], count=QUEUE_PAGES
+        )
+
+        # shuffle it
+        _, results["queue.shuffle"] = timed(queue.shuffle, count=size)
+
+        # remove from the middle of it
+        removes = [rng.randrange(size - QUEUE_REMOVES) for _ in range(QUEUE_REMOVES)]
+        _, results["queue.remove"] = timed(
+            lambda: [queue.remove(i) for i in removes], count=QUEUE_REMOVES
+        )
+
+        # move songs around in it
+        moves = [
+            (rng.randrange(size - QUEUE_REMOVES), rng.randrange(size - QUEUE_REMOVES))
+            for _ in range(QUEUE_REMOVES)
+        ]
+        _, results["queue.move"] = timed(
+            lambda: [queue.move(i, j) for i, j in moves], count=QUEUE_REMOVES
+        )
+
+        # drain it, as the player would
+        def drain():
+            while len(queue):
+                queue.get_nowait()
+        _, results["queue.get"] = timed(drain, count=size - QUEUE_REMOVES)
+
+    asyncio.run(run())
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, required=True)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--fuzzy-size', type=int, default=0)
+    parser.add_argument('--output', required=True)
+    args = parser.parse_args()
+
+    # run everything
+    results = {}
+    bench_db(results, args.seed, args.repeat)
+    bench_queue(results, max(args.size, QUEUE_REMOVES * 2), args.seed)
+    if args.fuzzy_size:
+        bench_fuzzy(results, args.fuzzy_size, args.seed, args.repeat)
+
+    # hand results back to the parent
+    with open(args.output, 'w') as f:
+        json.dump(results, f)
+
+if __name__ == '__main__':
+    sys.exit(main())
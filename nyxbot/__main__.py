@@ -1,33 +1,16 @@
-import os
-import sys
 import logging
 
 from .env import env
-from .discord import bot
-from .db import validate_config
+from .discord import create_bot
+from .db import validate_config, load_search_index
+from .shards import ShardSupervisor
+from .util.log import setup_logging
 
 def main():
     """Main function"""
 
     # set up logging
-    if not os.path.exists(env.config_path):
-        os.makedirs(env.config_path)
-
-    # configure logging basics for file
-    logging.basicConfig(
-        format="%(asctime)s %(name)-20s %(levelname)s: %(message)s",
-        datefmt="%m/%d/%Y %I:%M:%S %p",
-        level=logging.INFO,
-        filename=os.path.join(env.config_path, "music.log")
-    )
-
-    # configure logging basics for console
-    logging.getLogger().addHandler(logging.StreamHandler())
-    console = logging.StreamHandler(sys.stdout)
-    console.setLevel(logging.WARNING)
-
-    # add console handler to logger
-    logging.getLogger().addHandler(console)
+    setup_logging()
 
     # initialize bot
     logging.getLogger('NyxBot.main').info("Starting up...")
@@ -35,8 +18,15 @@ def main():
     # check config
     validate_config()
 
+    # hand off to shard workers, if asked to
+    if env.shard_processes > 1:
+        return ShardSupervisor(env.shard_count, env.shard_processes).run()
+
+    # load search index
+    load_search_index()
+
     # start bot
-    bot.run(env.token)
+    create_bot().run(env.token)
 
 if __name__ == "__main__":
-    exit(main())
\ No newline at end of file
+    exit(main())
@@ -4,17 +4,146 @@ import asyncio
 from discord.ext import commands, tasks
 
 from ..env import env
-from ..db import file_poll_thread
+from ..db import file_poll_thread, path_sync_thread, search_refresh_thread, \
+    loudness_thread, duration_thread, resume_thread, pending_thread, ScanResult
+from ..watcher import LibraryWatcher
+from ..progress import index_progress
+from ..util.format import format_duration
 from ..discord import EmbedColors
 
 dbadminLogger = logging.getLogger('NyxBot.cogs.DBAdmin')
 
+# least seconds between edits of a status embed, discord rate limits them
+STATUS_INTERVAL = 5
+
 class DBAdmin(commands.Cog):
     """Cog which helps keep database up to date"""
 
     def __init__(self, bot):
         self.bot = bot
 
+        # only one scan should touch the library at a time
+        self.scan_lock = asyncio.Lock()
+
+        # optional filesystem watcher
+        self.watcher = None
+
+    def cog_unload(self):
+        self.update_db_task.cancel()
+        self.watch_task.cancel()
+        self.refresh_index_task.cancel()
+        self.loudness_task.cancel()
+        if self.watcher:
+            self.watcher.stop()
+
+    #
+    # ===== [ Private Functions ] =====
+    #
+
+    async def _get_admin_channel(self):
+        """Gets the admin channel, even if it's on another worker's shard"""
+
+        return self.bot.get_channel(env.admin_channel) or \
+            await self.bot.fetch_channel(env.admin_channel)
+
+    def _scan_report(self, result):
+        """Formats a scan result into a report message"""
+
+        # list out each kind of change that happened
+        changes = []
+        if result.added > 0:
+            changes.append(f"{result.added} new files were just indexed")
+        if result.updated > 0:
+            changes.append(f"{result.updated} files were updated")
+        if result.removed > 0:
+            changes.append(f"{result.removed} missing files were removed")
+
+        # join them up into a sentence
+        if len(changes) > 1:
+            return ", ".join(changes[:-1]) + " and " + changes[-1] + "!"
+        return changes[0] + "!"
+
+    def _status_embed(self, status, title: str = "Indexing Library"):
+        """Formats an indexer status into an embed"""
+
+        # nothing going on
+        if not status.running and not status.dirs:
+            return discord.Embed(
+                description = "The indexer is idle.",
+                color = EmbedColors.DARK
+            )
+
+        # walking progress
+        e_str = f"`{status.path}`\n" + \
+            f"{status.dirs} folders walked, {status.found} audio files found\n"
+
+        # tagging progress, once there's any
+        if status.to_tag:
+            e_str += f"{status.tagged}/{status.to_tag} files tagged " + \
+                f"at {status.rate:.1f} files/s"
+            if status.running and status.eta is not None:
+                e_str += f", about {format_duration(status.eta)} left"
+            e_str += "\n"
+
+        e_str += ("Running for " if status.running else "Took ") + \
+            format_duration(status.elapsed)
+        return discord.Embed(
+            title = title,
+            description = e_str,
+            color = EmbedColors.INFO if status.running else EmbedColors.DARK
+        )
+
+    async def _full_scan(self, resume: bool):
+        """Finishes off interrupted indexing if asked, then scans everything"""
+
+        resumed = await resume_thread() if resume else ScanResult()
+        result = await file_poll_thread()
+        return ScanResult(*(a + b for a, b in zip(resumed, result)))
+
+    async def _scan_with_status(self, channel, scan):
+        """
+        Awaits a scan, keeping a single status embed in channel up to date
+        while it runs, rather than going quiet until it's done
+        """
+
+        # follow the indexer's progress, from its thread
+        latest = [index_progress.snapshot()]
+        changed = asyncio.Event()
+        def on_progress(status):
+            latest[0] = status
+            changed.set()
+        unsubscribe = index_progress.subscribe(self.bot.loop, on_progress)
+
+        message = await channel.send(embed=discord.Embed(
+            description="Beginning library scan...",
+            color=EmbedColors.DARK
+        ))
+        task = asyncio.ensure_future(scan)
+        try:
+
+            # edit the embed at most every STATUS_INTERVAL
+            while not task.done():
+                await asyncio.wait({task}, timeout=STATUS_INTERVAL)
+                if changed.is_set() and latest[0].running:
+                    changed.clear()
+                    try:
+                        await message.edit(embed=self._status_embed(latest[0]))
+                    except discord.HTTPException as e:
+                        dbadminLogger.error(f"Couldn't update status embed: {e}")
+            result = task.result()
+
+        # stop following, and leave the final numbers up
+        finally:
+            unsubscribe()
+        if latest[0].dirs:
+            try:
+                await message.edit(
+                    embed=self._status_embed(latest[0], "Indexing Finished")
+                )
+            except discord.HTTPException as e:
+                dbadminLogger.error(f"Couldn't update status embed: {e}")
+        return result
+
     #
     # ===== [ Task Related Stuff ] =====
     #
@@ -22,8 +151,88 @@ class DBAdmin(commands.Cog):
     @commands.Cog.listener()
     async def on_ready(self):
         await self.bot.wait_until_ready()
+
+        # on_ready fires again on reconnects, only start things once
+        if self.update_db_task.is_running() or \
+            self.refresh_index_task.is_running():
+            return
+
+        # shard workers that don't index just follow the library
+        if not env.run_indexer:
+            self.refresh_index_task.start()
+            return
+
+        # start watching for changes, if enabled
+        if env.watch_library:
+            self.watcher = LibraryWatcher(env.music_path, env.watch_debounce)
+            self.watcher.start()
+            self.watch_task.start()
+
+        # full scans act as a safety net
+        self.update_db_task.change_interval(minutes=env.scan_interval)
         self.update_db_task.start()
 
+        # measure new tracks' loudness in the background
+        self.loudness_task.start()
+
+    @tasks.loop(seconds=1)
+    async def watch_task(self):
+        """Private function which indexes paths the watcher saw change"""
+
+        # get touched paths, if they've settled
+        paths = self.watcher.drain()
+        if not paths:
+            return
+        dbadminLogger.info(f"Syncing {len(paths)} changed paths")
+
+        # sync them
+        async with self.scan_lock:
+            result = await path_sync_thread(paths)
+
+        # send report to channel if anything changed
+        if result.total > 0:
+            message = self._scan_report(result)
+            dbadminLogger.info(message)
+            await (await self._get_admin_channel()).send(
+                embed=discord.Embed(
+                    description=message,
+                    color=EmbedColors.DARK
+                )
+            )
+
+    @tasks.loop(minutes=5)
+    async def refresh_index_task(self):
+        """Private function which picks up library changes made elsewhere"""
+
+        if await search_refresh_thread():
+            dbadminLogger.info("Reloaded search index after library changed")
+
+    @tasks.loop(minutes=5)
+    async def loudness_task(self):
+        """Private function which measures the loudness of new tracks"""
+
+        # fill in durations of tracks indexed before we stored them
+        backfilled = 0
+        while True:
+            count = await duration_thread()
+            if count == 0:
+                break
+            backfilled += count
+
+        if backfilled > 0:
+            dbadminLogger.info(f"Read durations of {backfilled} older tracks")
+
+        # work through every unmeasured track, a batch at a time
+        measured = 0
+        while True:
+            count = await loudness_thread()
+            if count == 0:
+                break
+            measured += count
+
+        if measured > 0:
+            dbadminLogger.info(f"Measured loudness of {measured} tracks")
+
     @tasks.loop(minutes=30)
     async def update_db_task(self):
         """Private function which updates the database"""
@@ -31,7 +240,10 @@ class DBAdmin(commands.Cog):
         dbadminLogger.info("Running scheduled polling!")
 
         # get channel
-        adminChannel = self.bot.get_channel(env.admin_channel)
+        adminChannel = await self._get_admin_channel()
+
+        # long scans get a live status embed, short ones just a report
+        long_scan = env.first_run
 
         # print a warning on first run
         if env.first_run:
@@ -45,55 +257,101 @@ class DBAdmin(commands.Cog):
                 ))
             env.first_run = False
 
-        # start new polling thread
-        files_added = await file_poll_thread()
+        # an earlier index was cut short, say we're picking it back up
+        pending = await pending_thread()
+        if pending > 0:
+            long_scan = True
+            dbadminLogger.warn(f"Interrupted indexing found, {pending} files left")
+            await adminChannel.send(embed=discord.Embed(
+                    description="Picking up indexing where it left off, " + \
+                    f"with {pending} files to go! Everything indexed so " + \
+                    "far can already be searched.",
+                    color=EmbedColors.WARNING
+                ))
+
+        # finish that off first, then start new polling thread
+        async with self.scan_lock:
+            if long_scan:
+                result = await self._scan_with_status(
+                    adminChannel, self._full_scan(pending > 0)
+                )
+            else:
+                result = await self._full_scan(pending > 0)
 
         # send report to channel
-        if files_added > 0:
-            message = f"{files_added} new files were just indexed!"
+        if result.total > 0:
+            message = self._scan_report(result)
             dbadminLogger.info(message)
             await adminChannel.send(embed=discord.Embed(
                 description=message,
                 color=EmbedColors.DARK
             ))
 
-        # if no new files, say so
+        # if nothing changed, say so
         else:
-            message = "No new files were found."
+            message = "No library changes were found."
             dbadminLogger.info(message)
 
+    async def _on_indexer(self, ctx):
+        """Checks this worker runs the indexer, telling the user if it doesn't"""
+
+        if env.run_indexer:
+            return True
+        await ctx.send(embed=discord.Embed(
+            description="This shard doesn't index the library, " + \
+                "so it can't scan or report on indexing! Library " + \
+                "changes still get picked up every few minutes.",
+            color=EmbedColors.WARNING
+        ))
+        return False
+
     @commands.command(name="reindex", hidden=True)
     @commands.has_guild_permissions(administrator=True)
     async def _update(self, ctx):
         """Forcefully triggers a database update"""
 
+        # only the indexing worker may scan, under its scan lock
+        if not await self._on_indexer(ctx):
+            return
+
         # print warnings
         dbadminLogger.warn("Update command called manually...")
-        await ctx.send(embed=discord.Embed(
-            description=f"Beginning library scan...",
-            color=EmbedColors.DARK
-        ))
 
-        # start new polling thread
-        files_added = await file_poll_thread()
+        # start new polling thread, following along in a status embed
+        async with self.scan_lock:
+            result = await self._scan_with_status(ctx, file_poll_thread())
 
-        # send report to channel if files were added
-        if files_added > 0:
-            message = f"{files_added} new files were just indexed!"
+        # send report to channel if anything changed
+        if result.total > 0:
+            message = self._scan_report(result)
             dbadminLogger.info(message)
             await ctx.send(embed=discord.Embed(
                 description=message,
                 color=EmbedColors.DARK
             ))
         
-        # if no new files, say so
+        # if nothing changed, say so
         else:
-            message = "No new files were found."
+            message = "No library changes were found."
             dbadminLogger.info(message)
             await ctx.send(embed=discord.Embed(
                 description=message,
                 color=EmbedColors.DARK
             ))
 
+    @commands.command(name="indexstatus", hidden=True)
+    @commands.has_guild_permissions(administrator=True)
+    async def _indexstatus(self, ctx):
+        """Shows what the indexer is up to, or how its last run went"""
+
+        # other workers never see the indexer's progress
+        if not await self._on_indexer(ctx):
+            return
+
+        status = index_progress.snapshot()
+        await ctx.send(embed=self._status_embed(
+            status, "Indexing Library" if status.running else "Last Index"
+        ))
+
 def setup(bot):
     bot.add_cog(DBAdmin(bot))
\ No newline at end of file
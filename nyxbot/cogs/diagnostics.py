@@ -0,0 +1,85 @@
+import os
+import discord
+import logging
+from typing import Optional
+from discord.ext import commands
+
+from ..tracing import traces
+from ..profiling import profiler
+from ..discord import EmbedColors
+
+diagnosticsLogger = logging.getLogger('NyxBot.cogs.Diagnostics')
+
+class Diagnostics(commands.Cog):
+    """Cog with admin commands for looking into performance"""
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    @commands.command(name="slowplays", hidden=True)
+    @commands.has_guild_permissions(administrator=True)
+    async def _slowplays(self, ctx, count: Optional[int] = 5):
+        """Summarizes the slowest recent plays, from command to first audio"""
+
+        # get plays that made it to audio, ignoring time spent on prompts
+        plays = sorted(traces.finished("play"), key=lambda t: t.active)
+        if not plays:
+            await ctx.send(embed=discord.Embed(
+                description = "No plays have been traced yet!",
+                color = EmbedColors.DARK
+            ))
+            return
+
+        # overall percentiles
+        p50 = plays[len(plays) // 2].active
+        p95 = plays[min(len(plays) - 1, int(len(plays) * 0.95))].active
+        e_str = f"Time to first audio over the last {len(plays)} plays: " + \
+            f"p50 **{p50:.2f}s**, p95 **{p95:.2f}s**\n\n"
+
+        # the slowest, broken down by span
+        for trace in reversed(plays[-count:]):
+            spans = " → ".join(
+                f"{span['name']} {span['duration'] * 1000:.0f}ms"
+                for span in sorted(trace.spans, key=lambda s: s['start'])
+            )
+            e_str += f"**{trace.active:.2f}s** `{trace.attrs.get('query')}` " + \
+                f"({trace.id})\n{spans}\n"
+
+        # send embed
+        await ctx.send(embed=discord.Embed(
+            title = "Slowest Plays",
+            description = e_str[:4096],
+            color = EmbedColors.DARK
+        ))
+
+    @commands.command(name="slowcmds", hidden=True)
+    @commands.has_guild_permissions(administrator=True)
+    async def _slowcmds(self, ctx, count: Optional[int] = 10):
+        """Lists the slowest recent commands, and whether they were profiled"""
+
+        # get the slowest calls
+        calls = profiler.slowest(count)
+        if not calls:
+            await ctx.send(embed=discord.Embed(
+                description = "No commands have been slow yet!",
+                color = EmbedColors.DARK
+            ))
+            return
+
+        # list them, with how their command usually does
+        e_str = ""
+        for seconds, when, name, args, dump in calls:
+            total, mean, _ = profiler.stats(name)
+            e_str += f"**{seconds:.2f}s** `{name}` {args[:80]}\n" + \
+                f"usually {mean:.2f}s over {total} calls" + \
+                (f", profiled to `{os.path.basename(dump)}`" if dump else "") + "\n"
+
+        # send embed
+        await ctx.send(embed=discord.Embed(
+            title = "Slowest Commands",
+            description = e_str[:4096],
+            color = EmbedColors.DARK
+        ))
+
+def setup(bot):
+    bot.add_cog(Diagnostics(bot))
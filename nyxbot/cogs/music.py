@@ -1,15 +1,16 @@
 import emoji
-import random
-import asyncio
 import discord
 import logging
-import itertools
 from typing import Optional
-from discord.ext import commands
-from async_timeout import timeout
-
-from ..db import search_db
-from ..util.decorators import ensure_bot_in_channel
+from asyncio import QueueFull
+from discord.ext import commands, tasks
+
+from ..db import search_thread, album_thread, artist_thread
+from ..player import PlayerSession, TrackedSource
+from ..metrics import queue_depth
+from ..tracing import Trace, null_trace
+from ..util.decorators import ensure_bot_in_channel, profile_slow
+from ..util.format import format_duration
 from ..discord import EmbedColors
 
 musicLogger = logging.getLogger('NyxBot.cogs.Music')
@@ -20,29 +21,8 @@ NUMBER_LOOKUP_TABLE = [
     ":keycap_7:", ":keycap_8:", ":keycap_9:",
 ]
 
-class SongQueue(asyncio.Queue):
-    """Custom implementation of queue with helper functions for songs"""
-
-    def __getitem__(self, item):
-        if isinstance(item, slice):
-            return list(itertools.islice(self._queue, item.start, item.stop, item.step))
-        else:
-            return self._queue[item]
-
-    def __iter__(self):
-        return self._queue.__iter__()
-
-    def __len__(self):
-        return self.qsize()
-
-    def clear(self):
-        self._queue.clear()
-
-    def shuffle(self):
-        random.shuffle(self._queue)
-
-    def remove(self, index: int):
-        del self._queue[index]
+# songs shown per page of the queue
+QUEUE_PAGE_SIZE = 10
 
 class Music(commands.Cog):
     """Cog which holds the Music commands"""
@@ -53,162 +33,110 @@ class Music(commands.Cog):
         self.bot = bot
         self.timeout = 180
 
-        # prompt variables
-        self.latest_prompt_id = None
-        self.latest_prompt_ctx = None
-        self.latest_prompt_data = None
-
-        # audio player stuff
-        self.audio_player_thread = None
-        self.voice_client = None
-        self.player_loop = False
-        self.player_volume = 0.2
-
-        # song queue
-        self.current_song = None
-        self.start_next_song = asyncio.Event()
-        self.song_queue = SongQueue(maxsize=10)
-
-    def __del__(self):
-        self.audio_player_thread.cancel()
-    
-    #
-    # ===== [ Voice State Functions ] =====
-    #
-
-    async def _audio_player_task(self):
-        """Main async task that handles playing songs"""
+        # player sessions, by guild id
+        self.sessions = {}
+        self.reap_sessions.start()
 
-        # print that the audio player thread has started
-        musicLogger.info("_audio_player_task started!")
+        # report queue depths when scraped
+        queue_depth.set_function(lambda: {
+            (str(guild_id),): len(session.song_queue)
+            for guild_id, session in self.sessions.items()
+        })
 
-        # put everything in a try block
-        try:
+    def cog_unload(self):
+        self.reap_sessions.cancel()
+        for session in list(self.sessions.values()):
+            self.bot.loop.create_task(session.destroy())
 
-            # loop forever
-            while True:
-
-                # clear the mutex
-                self.start_next_song.clear()
-
-                # if we're not set to loop, try getting next song
-                if not self.player_loop:
-
-                    # this will attempt to get a song from asyncio's queue
-                    # it will time out after 3 minutes, disconnecting
-                    # if no song is put in the quete
-                    try:
-                        async with timeout(self.timeout):
-                            self.current = await self.song_queue.get()
-                            musicLogger.info(
-                                "Got next song from queue! " + \
-                                f"{self.current['title']}"
-                            )
-                    except asyncio.TimeoutError:
-                        self.bot.loop.create_task(self._stop_audio_player())
-                        return
-
-                # prep the song
-                audio_source = discord.FFmpegPCMAudio(self.current['path'])
-                src_w_vol = discord.PCMVolumeTransformer(
-                    audio_source, volume = self.player_volume
-                )
-
-                # race condition check
-                if self.voice_client.is_playing():
-                    musicLogger.critical(
-                        "Detected race condition: " + \
-                        "Started next song while already playing. " + \
-                        "Please ensure there is only one task running!"
-                    )
-
-                # play the song
-                self.voice_client.play(
-                    src_w_vol,
-                    after=self._play_next_song
-                )
-
-                # set the volume
-                self.voice_client.source.volume = self.player_volume
+    #
+    # ===== [ Session Functions ] =====
+    #
 
-                # wait for song to finish playing
-                # the callback should set this mutex,
-                # allowing this loop to continue
-                await self.start_next_song.wait()
-        
-        # catch all exceptions
-        except BaseException as e:
+    def _get_session(self, guild: discord.Guild):
+        """Gets a guild's player session, creating it if needed"""
 
-            # if it's a CancelledError, ignore it
-            if type(e) is asyncio.CancelledError:
-                musicLogger.info("_audio_player_task interrupted! Exiting...")
-                return
-            
-            # else, its an actual error
-            musicLogger.critical(
-                "_audio_player_task error: " + \
-                type(e).__name__ + " - " + str(e)
+        # create lazily
+        session = self.sessions.get(guild.id)
+        if session is None:
+            session = PlayerSession(
+                self.bot, guild.id, self.timeout,
+                on_destroy=self._forget_session
             )
-            raise
+            self.sessions[guild.id] = session
+            musicLogger.info(f"Created player session for {guild.id}")
 
-    def _play_next_song(self, error: Optional[Exception]):
-        """Called when a song is done playing"""
+        # mark it as in use
+        session.touch()
+        return session
 
-        # if there was an error
-        if error:
-            raise error
+    def _forget_session(self, session: PlayerSession):
+        """Drops a destroyed session"""
 
-        # set the next event
-        self.start_next_song.set()
+        if self.sessions.get(session.guild_id) is session:
+            del self.sessions[session.guild_id]
+            musicLogger.info(f"Destroyed player session for {session.guild_id}")
 
-    async def _stop_audio_player(self):
-        """Stops the audio player"""
+    @tasks.loop(minutes=1)
+    async def reap_sessions(self):
+        """Tears down sessions that have sat idle"""
 
-        # clear the queue
-        self.song_queue.clear()
-
-        # stop the player thread
-        self.audio_player_thread.cancel()
-
-        # disconnect, if connected
-        if self.voice_client:
-            await self.voice_client.disconnect()
-            self.voice_client = None
+        for session in list(self.sessions.values()):
+            if session.is_idle():
+                await session.destroy()
 
     #
     # ===== [ Private Functions ] =====
     #
 
+    @profile_slow
     async def _join_channel(self, ctx, channel: discord.VoiceChannel):
         """Private function which joins a voice channel"""
 
         # join or move a channel
         if ctx.voice_client is not None:
             await ctx.voice_client.move_to(channel)
+            voice_client = ctx.voice_client
         else:
-            self.voice_client = await channel.connect()
+            voice_client = await channel.connect()
 
         # now that we're connected, we can start the audio player thread
-        self.audio_player_thread = self.bot.loop.create_task(
-            self._audio_player_task()
-        )
+        self._get_session(ctx.guild).start(voice_client)
 
-    async def _leave_channel(self):
+    async def _leave_channel(self, ctx):
         """Private function which leaves a voice channel"""
 
-        if self.voice_client is not None:
-            await self._stop_audio_player()
+        session = self._get_session(ctx.guild)
+        if session.voice_client is not None:
+            await session.destroy()
 
-    async def _queue_file(self, ctx, db_entry):
+    @profile_slow
+    async def _queue_file(self, ctx, db_entry, trace: Trace = null_trace):
         """Queues a file, given a path"""
 
-        # get queue size
-        q_size = self.song_queue.qsize()
+        # if nothing's in the queue, the player picks up the trace once
+        # the song's in; otherwise there's no first audio to wait for
+        session = self._get_session(ctx.guild)
+        trace.begin("queue")
+        playing_next = session.song_queue.qsize() == 0 and \
+            not session.voice_client.is_playing()
+        entry = dict(db_entry, trace=trace) if playing_next else db_entry
 
-        # if nothing's in the queue, put a playing embed
-        if q_size == 0 and not self.voice_client.is_playing():
+        # add to queue before anything awaits, so the check for room
+        # and the put can't be split by another command
+        try:
+            session.song_queue.put_nowait(entry)
+        except QueueFull:
+            trace.finish("queue_full")
+            await ctx.send(embed=discord.Embed(
+                description = "The queue is full!",
+                color = EmbedColors.DANGER
+            ))
+            return
+        trace.end("queue")
 
-            # print an embed, saying that we're playing
+        # print an embed, saying that we're playing
+        if playing_next:
+            trace.begin("wait_player")
             await ctx.send(embed=discord.Embed(
                 title = "Now Playing:",
                 description = f"{db_entry['artist']} - {db_entry['title']}",
@@ -217,18 +145,42 @@ class Music(commands.Cog):
 
         # else, if stuff is in the queue, send a queued embed
         else:
-
-            # send an embed, saying that we added the song
             await ctx.send(embed=discord.Embed(
                 title = "Added to Queue:",
                 description = f"{db_entry['artist']} - {db_entry['title']}",
                 color = EmbedColors.DARK
             ))
+            trace.finish("queued")
+
+    @profile_slow
+    async def _queue_files(self, ctx, db_entries: list, title: str):
+        """Queues a batch of files at once, with a single embed"""
+
+        # add them all in one go
+        session = self._get_session(ctx.guild)
+        queued = session.song_queue.extend(db_entries)
+
+        # if none fit, say so
+        if queued == 0:
+            await ctx.send(embed=discord.Embed(
+                description = "The queue is full!",
+                color = EmbedColors.DANGER
+            ))
+            return
 
-        # add to queue
-        await self.song_queue.put(db_entry)
+        # otherwise sum up what got added
+        duration = sum(entry['duration'] or 0 for entry in db_entries[:queued])
+        description = f"{title}\n{queued} songs ({format_duration(duration)})"
+        if queued < len(db_entries):
+            description += f", {len(db_entries) - queued} didn't fit"
+        await ctx.send(embed=discord.Embed(
+            title = "Added to Queue:",
+            description = description,
+            color = EmbedColors.DARK
+        ))
 
-    async def _send_prompt_embed(self, ctx, results):
+    @profile_slow
+    async def _send_prompt_embed(self, ctx, results, trace: Trace = null_trace):
         """Sends a prompt embed"""
 
         # format embed string
@@ -237,11 +189,18 @@ class Music(commands.Cog):
             e_str += f"**{i + 1}.)** {v['artist']} - {v['title']}\n"
 
         # cache results for further processing upon response
-        self.latest_prompt_ctx = ctx
-        self.latest_prompt_data = results
+        session = self._get_session(ctx.guild)
+        session.latest_prompt_ctx = ctx
+        session.latest_prompt_data = results
+
+        # an unanswered prompt we're replacing won't play
+        if session.latest_prompt_trace is not None:
+            session.latest_prompt_trace.finish("abandoned")
+        session.latest_prompt_trace = trace
+        trace.begin("prompt_embed")
 
         # send embed
-        self.latest_prompt_message = await ctx.send(embed=discord.Embed(
+        session.latest_prompt_message = await ctx.send(embed=discord.Embed(
             title = "Multiple results found! Please select one:",
             description = e_str,
             color = EmbedColors.LIGHT
@@ -252,12 +211,16 @@ class Music(commands.Cog):
         # a quick responder. just ignore that for now.
         try:
             for i in range(len(results)):
-                await self.latest_prompt_message.add_reaction(
+                await session.latest_prompt_message.add_reaction(
                     emoji.emojize(NUMBER_LOOKUP_TABLE[i])
                 )
         except discord.errors.NotFound:
             pass
 
+        # time how long it takes to get an answer
+        trace.end("prompt_embed")
+        trace.begin("prompt")
+
     #
     # ===== [ Join & Leave Commands ] =====
     #
@@ -303,7 +266,7 @@ class Music(commands.Cog):
         """Makes NyxBot join leave the voice channel it's in"""
 
         # disconnect
-        await self._leave_channel()
+        await self._leave_channel(ctx)
 
         # and add a reaction!
         await ctx.message.add_reaction(
@@ -353,41 +316,88 @@ class Music(commands.Cog):
         # else, if a query was passed in, handle it
         else:
 
+            # trace it, from here to the first audio going out
+            trace = Trace("play", guild=ctx.guild.id, query=query)
+
             # join the channel if we're not in one
             if ctx.voice_client is None:
-                await self._join_channel(ctx, ctx.author.voice.channel)
+                with trace.span("join"):
+                    await self._join_channel(ctx, ctx.author.voice.channel)
 
             # search for the song
-            results = search_db(query)
+            with trace.span("search"):
+                results = await search_thread(query)
+            trace.attrs["results"] = len(results)
 
             # if more than one result, send a prompt embed
             if len(results) > 1:
                 
                 # send embed
-                await self._send_prompt_embed(ctx, results)
+                await self._send_prompt_embed(ctx, results, trace)
 
             # if there's only one song in the results...
             elif len(results) == 1:
 
                 # add to queue
-                await self._queue_file(ctx, results[0])
+                await self._queue_file(ctx, results[0], trace)
 
             # if we couldnt find a song, send an embed
             else:
+                trace.finish("no_results")
                 await ctx.send(embed=discord.Embed(
                     description = "I couldn't find any song that matches your query!",
                     color = EmbedColors.DANGER
                 ))
 
+    @commands.command(name="album", aliases=["al"])
+    async def _album(self, ctx, *, query: str):
+        """Queues every track of the best matching album"""
+
+        # join the channel if we're not in one
+        if ctx.voice_client is None:
+            await self._join_channel(ctx, ctx.author.voice.channel)
+
+        # look it up
+        tracks = await album_thread(query)
+        if not tracks:
+            await ctx.send(embed=discord.Embed(
+                description = "I couldn't find any album that matches your query!",
+                color = EmbedColors.DANGER
+            ))
+            return
+
+        # queue it
+        await self._queue_files(
+            ctx, tracks, f"{tracks[0]['artist']} - {tracks[0]['album']}"
+        )
+
+    @commands.command(name="artist", aliases=["ar"])
+    async def _artist(self, ctx, *, query: str):
+        """Queues every track of the best matching artist"""
+
+        # join the channel if we're not in one
+        if ctx.voice_client is None:
+            await self._join_channel(ctx, ctx.author.voice.channel)
+
+        # look it up
+        tracks = await artist_thread(query)
+        if not tracks:
+            await ctx.send(embed=discord.Embed(
+                description = "I couldn't find any artist that matches your query!",
+                color = EmbedColors.DANGER
+            ))
+            return
+
+        # queue it
+        await self._queue_files(ctx, tracks, tracks[0]['artist'])
+
     @commands.command(name="stop", aliases=["st"])
     @ensure_bot_in_channel
     async def _stop(self, ctx):
         """Stops playing music and clears the queue"""
 
         # clear the queue
-        for _ in range(self.song_queue.qsize()):
-            self.song_queue.get_nowait()
-            self.song_queue.task_done()
+        self._get_session(ctx.guild).song_queue.clear()
 
         # stop the music...
         ctx.voice_client.stop()
@@ -403,14 +413,14 @@ class Music(commands.Cog):
         """Pauses current song, if one is playing"""
 
         # if we're already paused
-        if ctx.voice_state.is_paused():
+        if ctx.voice_client.is_paused():
             await ctx.send(embed=discord.Embed(
                 description = "I'm already paused!",
                 color = EmbedColors.DANGER
             ))
 
         # if we're playing something...
-        elif ctx.voice_state.is_playing():
+        elif ctx.voice_client.is_playing():
 
             # pause the music...
             ctx.voice_client.pause()
@@ -426,7 +436,7 @@ class Music(commands.Cog):
         """Clears the queue"""
 
         # clear the queue
-        self.song_queue.clear()
+        self._get_session(ctx.guild).song_queue.clear()
 
         # send an embed
         await ctx.send(embed=discord.Embed(
@@ -458,8 +468,9 @@ class Music(commands.Cog):
 
         # if something is playing, send an embed
         if ctx.voice_client.is_playing():
+            current = self._get_session(ctx.guild).current
             await ctx.send(embed=discord.Embed(
-                description = f"**Now Playing:**\n {self.current['artist']} - {self.current['title']}",
+                description = f"**Now Playing:**\n {current['artist']} - {current['title']}",
                 color = EmbedColors.DARK
             ))
 
@@ -472,24 +483,34 @@ class Music(commands.Cog):
 
     @commands.command(name="queue", aliases=["q"])
     @ensure_bot_in_channel
-    async def _queue(self, ctx):
-        """Print the current queue"""
+    async def _queue(self, ctx, page: Optional[int] = 1):
+        """Print a page of the current queue"""
 
         # temp vars
+        session = self._get_session(ctx.guild)
+        queue = session.song_queue
         embed_contents = ""
         now_playing_str = ""
         queue_str = ""
 
-        # if something is playing, get that
+        # if something is playing, get that, and how long it has left
+        remaining = queue.duration
         if ctx.voice_client.is_playing():
-            now_playing_str = f"**Now Playing:**\n {self.current['artist']} - {self.current['title']}"
-
-        # if there's stuff in the queue, get that too
-        if self.song_queue.qsize() == 0:
+            now_playing_str = f"**Now Playing:**\n {session.current['artist']} - {session.current['title']}"
+            source = ctx.voice_client.source
+            if isinstance(source, TrackedSource):
+                remaining += max((session.current['duration'] or 0) - source.position, 0)
+
+        # if there's stuff in the queue, get just the page being shown
+        pages = max((len(queue) + QUEUE_PAGE_SIZE - 1) // QUEUE_PAGE_SIZE, 1)
+        page = min(max(page, 1), pages)
+        start = (page - 1) * QUEUE_PAGE_SIZE
+        if queue.qsize() == 0:
             queue_str = "Queue is empty!"
         else:
-            for i, song in enumerate(self.song_queue, start=0):
-                queue_str += f"**{i + 1}.)** {song['artist']} - {song['title']}\n"
+            for i, song in enumerate(queue[start:start + QUEUE_PAGE_SIZE], start=start):
+                queue_str += f"**{i + 1}.)** {song['artist']} - {song['title']}"[:200] + \
+                    f" ({format_duration(song['duration'] or 0)})\n"
 
         # format embed contents
         if now_playing_str != "":
@@ -498,9 +519,58 @@ class Music(commands.Cog):
         embed_contents += queue_str
 
         # send embed
-        await ctx.send(embed=discord.Embed(
+        embed = discord.Embed(
             description = embed_contents,
             color = EmbedColors.DARK
+        )
+        embed.set_footer(
+            text = f"Page {page}/{pages} • {len(queue)} songs • " + \
+                f"{format_duration(remaining)} remaining"
+        )
+        await ctx.send(embed=embed)
+
+    @commands.command(name="remove", aliases=["rm"])
+    @ensure_bot_in_channel
+    async def _remove(self, ctx, position: int):
+        """Removes a song from the queue, by its position"""
+
+        # make sure it's in the queue
+        queue = self._get_session(ctx.guild).song_queue
+        if not 1 <= position <= len(queue):
+            await ctx.send(embed=discord.Embed(
+                description = f"Position must be between 1 and {len(queue)}!",
+                color = EmbedColors.DANGER
+            ))
+            return
+
+        # remove it
+        song = queue.remove(position - 1)
+        await ctx.send(embed=discord.Embed(
+            title = "Removed from Queue:",
+            description = f"{song['artist']} - {song['title']}",
+            color = EmbedColors.DARK
+        ))
+
+    @commands.command(name="move", aliases=["mv"])
+    @ensure_bot_in_channel
+    async def _move(self, ctx, position: int, to: int):
+        """Moves a song in the queue to another position"""
+
+        # make sure both are in the queue
+        queue = self._get_session(ctx.guild).song_queue
+        if not (1 <= position <= len(queue) and 1 <= to <= len(queue)):
+            await ctx.send(embed=discord.Embed(
+                description = f"Positions must be between 1 and {len(queue)}!",
+                color = EmbedColors.DANGER
+            ))
+            return
+
+        # move it
+        song = queue.move(position - 1, to - 1)
+        await ctx.send(embed=discord.Embed(
+            title = f"Moved to Position {to}:",
+            description = f"{song['artist']} - {song['title']}",
+            color = EmbedColors.DARK
         ))
 
     #
@@ -513,8 +583,9 @@ class Music(commands.Cog):
         """Toggles looping"""
 
         # if looping is enabled, disable it
-        if self.player_loop:
-            self.player_loop = False
+        session = self._get_session(ctx.guild)
+        if session.player_loop:
+            session.player_loop = False
             await ctx.send(embed=discord.Embed(
                 description = "Looping disabled!",
                 color = EmbedColors.DARK
@@ -522,7 +593,7 @@ class Music(commands.Cog):
 
         # if looping is disabled, enable it
         else:
-            self.player_loop = True
+            session.player_loop = True
             await ctx.send(embed=discord.Embed(
                 description = "Looping enabled!",
                 color = EmbedColors.DARK
@@ -534,7 +605,7 @@ class Music(commands.Cog):
         """Shuffle the queue"""
 
         # shuffle the queue
-        self.song_queue.shuffle()
+        self._get_session(ctx.guild).song_queue.shuffle()
 
         # send an embed
         await ctx.send(embed=discord.Embed(
@@ -548,8 +619,9 @@ class Music(commands.Cog):
         """Print volume, or change if specified (0-100)"""
 
         # if no volume was passed in, send an embed
+        session = self._get_session(ctx.guild)
         if volume is None:
-            cur_volume = int(ctx.voice_client.source.volume * 100)
+            cur_volume = int(session.player_volume * 100)
             await ctx.send(embed=discord.Embed(
                 description = f"Current Volume: {cur_volume}%",
                 color = EmbedColors.DARK
@@ -571,10 +643,9 @@ class Music(commands.Cog):
                 await ctx.send("Volume must be between 0 and 100!")
                 return
             
-            # make changes
-            self.player_volume = volume / 100
-            if ctx.voice_client.source:
-                ctx.voice_client.source.volume = self.player_volume
+            # make changes; ffmpeg applies volume, so the current song
+            # gets restarted where it is
+            await session.set_volume(volume / 100)
 
             # add a reaction!
             await ctx.message.add_reaction(
@@ -590,7 +661,7 @@ class Music(commands.Cog):
         """Searches DB for songs"""
 
         # search for the songs
-        results = search_db(query)
+        results = await search_thread(query)
 
         # if we found songs, send an embed
         if results:
@@ -628,8 +699,14 @@ class Music(commands.Cog):
         if user.bot:
             return
 
+        # ignore guilds without a session, they can't have a prompt
+        guild = reaction.message.guild
+        session = self.sessions.get(guild.id) if guild else None
+        if session is None or session.latest_prompt_message is None:
+            return
+
         # if the message is the latest prompt message...
-        if reaction.message.id == self.latest_prompt_message.id:
+        if reaction.message.id == session.latest_prompt_message.id:
 
             # if the reaction is a number...
             emote_str = emoji.demojize(str(reaction.emoji))
@@ -639,21 +716,25 @@ class Music(commands.Cog):
                 index = NUMBER_LOOKUP_TABLE.index(emote_str)
 
                 # if the index is within the range of the results...
-                if index < len(self.latest_prompt_data):
+                if index < len(session.latest_prompt_data):
 
                     # add to queue
+                    trace = session.latest_prompt_trace or null_trace
+                    trace.end("prompt")
                     await self._queue_file(
-                        self.latest_prompt_ctx,
-                        self.latest_prompt_data[index]
+                        session.latest_prompt_ctx,
+                        session.latest_prompt_data[index],
+                        trace
                     )
 
                     # delete the message
-                    await self.latest_prompt_message.delete()
+                    await session.latest_prompt_message.delete()
 
                     # clear the cache
-                    self.latest_prompt_id = None
-                    self.latest_prompt_ctx = None
-                    self.latest_prompt_data = None
+                    session.latest_prompt_message = None
+                    session.latest_prompt_ctx = None
+                    session.latest_prompt_data = None
+                    session.latest_prompt_trace = None
 
                 # if the index is not within the range of the results...
                 else:
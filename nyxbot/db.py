@@ -1,15 +1,65 @@
 import os
+import re
 import glob
+import time
 import sqlite3
-import difflib
 import logging
+import typing
+import threading
+import contextlib
 from tinytag import TinyTag
+from concurrent.futures import wait, FIRST_COMPLETED
 
 from .env import env, DB_NAME
-from .util.threading import to_thread
+from .search import search_index, search_cache
+from .metrics import search_seconds, search_results, index_seconds, \
+    index_files, index_files_per_second, search_cache_hits, search_cache_misses, \
+    search_cache_size
+from .transcode import transcode_executor, measure_gain
+from .progress import index_progress
+from .util.threading import InstrumentedExecutor, \
+    InstrumentedProcessExecutor, run_in
 
 dbLogger = logging.getLogger('NyxBot.db')
 
+# number of results returned by a search, one per prompt reaction
+SEARCH_LIMIT = 9
+
+# batches smaller than this per worker are tagged in-thread
+SMALL_BATCH = 32
+
+# tracks measured per loudness pass
+LOUDNESS_BATCH = 50
+
+# tracks from before durations were read, backfilled per pass
+DURATION_BATCH = 200
+
+# file types we index
+AUDIO_EXTENSIONS = (".mp3", ".flac", ".wav")
+
+# columns added to the library table before migrations existed
+ADDED_COLUMNS = {
+    "size": "INTEGER",
+    "mtime": "INTEGER",
+    "inode": "INTEGER",
+    "gain": "REAL",
+    "duration": "REAL",
+}
+
+# bm25 column weights for title, artist and album respectively
+BM25_WEIGHTS = (10.0, 5.0, 2.0)
+
+class ScanResult(typing.NamedTuple):
+    """Counts of library rows changed by a scan"""
+
+    added: int = 0
+    updated: int = 0
+    removed: int = 0
+
+    @property
+    def total(self):
+        return self.added + self.updated + self.removed
+
 def validate_config():
     """Verifies configs are valid, and initializes them if needed"""
 
@@ -19,21 +69,128 @@ def validate_config():
         dbLogger.warning("Config not found. Creating...")
         _init_db()
 
+    # bring older databases up to date
+    _migrate()
+
+class ConnectionManager():
+    """Hands out long lived, tuned connections to the database"""
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.path})"
+
+    def __init__(self, path: str):
+        self.path = path
+
+        # readers get one connection per thread, so searches never
+        # wait on each other; there's a single, shared writer
+        self._local = threading.local()
+        self._readers = set()
+        self._readers_lock = threading.Lock()
+        self._writer = None
+        self._write_lock = threading.RLock()
+
+    def _connect(self, readonly: bool, shared: bool = False):
+        """Opens a connection and applies our pragmas"""
+
+        # connect to database; shared connections get passed between
+        # threads, but only ever used by one at a time under a lock
+        conn = sqlite3.connect(
+            self.path,
+            timeout=env.db_busy_timeout,
+            cached_statements=env.db_statement_cache,
+            check_same_thread=not shared
+        )
+        conn.row_factory = sqlite3.Row
+
+        # WAL lets readers carry on while the writer commits. it sticks
+        # to the file, so only the writer needs to ask for it
+        if not readonly:
+            conn.execute('PRAGMA journal_mode = WAL;')
+
+        # tune everything else
+        conn.execute(f'PRAGMA synchronous = {env.db_synchronous};')
+        conn.execute(f'PRAGMA cache_size = -{env.db_cache_size};')
+        conn.execute(f'PRAGMA mmap_size = {env.db_mmap_size};')
+        conn.execute('PRAGMA temp_store = MEMORY;')
+        if readonly:
+            conn.execute('PRAGMA query_only = ON;')
+
+        return conn
+
+    def reader(self):
+        """Gets this thread's read only connection"""
+
+        # readers are tracked so close can reach every thread's; they
+        # open shared only so it's allowed to, each stays on its thread
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or conn not in self._readers:
+            conn = self._local.conn = self._connect(readonly=True, shared=True)
+            with self._readers_lock:
+                self._readers.add(conn)
+        return conn
+
+    @contextlib.contextmanager
+    def writer(self):
+        """Borrows the writer, committing on success"""
+
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = self._connect(readonly=False, shared=True)
+
+            # roll back anything half done if we blow up
+            try:
+                yield self._writer
+                self._writer.commit()
+            except BaseException:
+                self._writer.rollback()
+                raise
+
+    def close(self):
+        """Closes every connection; threads asking again get new ones"""
+
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        with self._readers_lock:
+            readers, self._readers = self._readers, set()
+        for conn in readers:
+            conn.close()
+
+db_conns = ConnectionManager(os.path.join(env.config_path, DB_NAME))
+
+# library generation the fuzzy index was last loaded at
+_search_index_generation = None
+
+# bounded pool for queries coming from the event loop, so they never
+# run on it, nor queue up behind scans
+db_executor = InstrumentedExecutor('db', env.db_workers)
+
+# scans, syncs and other library upkeep; scans take turns under the
+# scan lock, the other threads keep loudness and refreshes moving
+index_executor = InstrumentedExecutor('index', env.index_threads)
+
+# directory listings, fanned out by scans
+scan_executor = InstrumentedExecutor('scan', env.scan_workers)
+
+# report how full the search cache is when scraped
+search_cache_size.set_function(lambda: {(): len(search_cache)})
+
 def _get_db_conn():
-    """Makes a connection to the database"""
+    """Gets a read only connection to the database"""
 
-    # connect to database
-    _db_conn = sqlite3.connect(
-        os.path.join(env.config_path, DB_NAME)
-    )
-    _db_conn.row_factory = sqlite3.Row
-    return _db_conn
+    return db_conns.reader()
+
+def _get_db_writer():
+    """Gets the writable connection to the database, as a context"""
+
+    return db_conns.writer()
 
 def _init_db():
     """Initializes the DB"""
 
     # connect to database
-    with _get_db_conn() as conn:
+    with _get_db_writer() as conn:
 
         # create tables
         conn.execute('''CREATE TABLE "library" (
@@ -44,124 +201,997 @@ def _init_db():
             "tracknum"	INTEGER,
             "discnum"	INTEGER,
             "path"	    TEXT,
+            "size"	    INTEGER,
+            "mtime"	    INTEGER,
+            "inode"	    INTEGER,
+            "gain"	    REAL,
+            "duration"	REAL,
             PRIMARY KEY("id" AUTOINCREMENT)
         );''')
 
         # commit changes
         conn.commit()
 
-@to_thread
+def _migrate():
+    """Runs any schema migrations the database hasn't had yet"""
+
+    # connect to database
+    with _get_db_writer() as conn:
+
+        # user_version counts the migrations already run
+        version = conn.execute('PRAGMA user_version;').fetchone()[0]
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            dbLogger.warning(f"Migrating database to version {number}...")
+
+            # each migration commits along with its version, or not at all
+            conn.execute('BEGIN;')
+            migration(conn)
+            conn.execute(f'PRAGMA user_version = {number};')
+            conn.commit()
+
+def _migration_1(conn):
+    """
+    Catches up databases from before migrations, and adds the full text
+    and artist indexes, which new databases need too
+    """
+
+    # add any columns we're missing
+    cur = conn.execute('PRAGMA table_info(library);')
+    columns = set(row['name'] for row in cur.fetchall())
+    for name, decl in ADDED_COLUMNS.items():
+        if name not in columns:
+            dbLogger.warning(f"Adding missing column {name}...")
+            conn.execute(f'ALTER TABLE library ADD COLUMN "{name}" {decl};')
+
+    # create an external content full text index over the library
+    # table, populating it from any rows that already exist
+    cur = conn.execute('''
+        SELECT name FROM sqlite_master
+            WHERE type = 'table' AND name = 'library_fts';
+    ''')
+    if cur.fetchone() is None:
+        dbLogger.warning("Search index not found. Creating...")
+        conn.execute('''CREATE VIRTUAL TABLE "library_fts" USING fts5(
+            title,
+            artist,
+            album,
+            content='library',
+            content_rowid='id',
+            prefix='2 3',
+            tokenize='unicode61 remove_diacritics 2'
+        );''')
+        conn.execute('''
+            INSERT INTO library_fts(library_fts) VALUES('rebuild');
+        ''')
+
+    # artists, then their albums, in the order tracks get queued;
+    # serves artist lookups, and album lookups by artist, without a sort
+    conn.execute('''CREATE INDEX IF NOT EXISTS "library_artist_album" ON library(
+        artist COLLATE NOCASE, album COLLATE NOCASE, discnum, tracknum
+    );''')
+
+def _migration_2(conn):
+    """Makes paths unique, so files can be upserted by path"""
+
+    # drop duplicate rows, keeping the oldest of each
+    cur = conn.execute('''
+        SELECT id FROM library
+            WHERE id NOT IN (SELECT min(id) FROM library GROUP BY path);
+    ''')
+    duplicates = [row['id'] for row in cur.fetchall()]
+    if duplicates:
+        dbLogger.warning(f"Removing {len(duplicates)} duplicate library rows...")
+        _delete_rows(conn, duplicates)
+
+    # also makes path lookups and range scans indexed
+    conn.execute('''CREATE UNIQUE INDEX "library_path" ON library(path);''')
+
+def _migration_3(conn):
+    """Indexes albums on their own, in track order"""
+
+    conn.execute('''CREATE INDEX "library_album" ON library(
+        album COLLATE NOCASE, discnum, tracknum
+    );''')
+
+def _migration_4(conn):
+    """Adds the table checkpointing files still waiting to be tagged"""
+
+    conn.execute('''CREATE TABLE "pending" (
+        "path"  TEXT NOT NULL,
+        PRIMARY KEY("path")
+    ) WITHOUT ROWID;''')
+
+def _migration_5(conn):
+    """Adds the table remembering files whose tags can't be read"""
+
+    conn.execute('''CREATE TABLE "unreadable" (
+        "path"  TEXT NOT NULL,
+        "size"  INTEGER,
+        "mtime" INTEGER,
+        PRIMARY KEY("path")
+    ) WITHOUT ROWID;''')
+
+def _migration_6(conn):
+    """Adds the generation counter bumped whenever library rows change"""
+
+    conn.execute('''CREATE TABLE "meta" (
+        "key"   TEXT NOT NULL,
+        "value" INTEGER NOT NULL,
+        PRIMARY KEY("key")
+    ) WITHOUT ROWID;''')
+    conn.execute("INSERT INTO meta(key, value) VALUES('generation', 0);")
+
+# schema migrations, oldest first; only ever append to this
+MIGRATIONS = (
+    _migration_1,
+    _migration_2,
+    _migration_3,
+    _migration_4,
+    _migration_5,
+    _migration_6,
+)
+
+def _bump_generation(conn):
+    """Marks the library as changed, in the caller's transaction"""
+
+    conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation';")
+
+def library_generation():
+    """
+    Gets the library's generation; it changes whenever rows are added,
+    updated, moved or removed, by any process, but not when only gains
+    or other upkeep get written
+    """
+
+    return _get_db_conn().execute(
+        "SELECT value FROM meta WHERE key = 'generation';"
+    ).fetchone()[0]
+
+def load_search_index():
+    """Builds the in-memory fuzzy search index from the library"""
+
+    # time how long this takes, it's a startup cost
+    global _search_index_generation
+    start = time.perf_counter()
+
+    # note the generation first; anything committed after it gets
+    # picked up by the next refresh
+    _search_index_generation = library_generation()
+
+    # connect to database
+    with _get_db_conn() as conn:
+
+        # read every row into the index
+        cur = conn.execute('SELECT id, title, artist FROM library;')
+        search_index.rebuild(tuple(row) for row in cur)
+
+    # log stats
+    dbLogger.info(
+        f"Built search index with {len(search_index)} keys " + \
+        f"in {time.perf_counter() - start:.2f}s"
+    )
+
+def refresh_search_index():
+    """
+    Rebuilds the fuzzy search index if another process changed the
+    library; used by shard workers that don't index themselves
+    Returns: Whether the index was rebuilt
+    """
+
+    # nothing's changed
+    if library_generation() == _search_index_generation:
+        return False
+
+    # reload everything
+    load_search_index()
+    search_cache.invalidate()
+    return True
+
+@run_in(index_executor)
+def search_refresh_thread():
+    """Threaded function for refreshing the search index"""
+
+    # refresh
+    return refresh_search_index()
+
+@run_in(index_executor)
 def file_poll_thread():
     """Threaded function for polling files"""
 
     # poll files
-    return poll_new_files()
+    with index_progress.run(env.music_path):
+        return poll_new_files()
+
+@run_in(index_executor)
+def path_sync_thread(paths):
+    """Threaded function for rescanning touched paths"""
+
+    # sync paths
+    with index_progress.run(env.music_path):
+        return sync_paths(paths)
+
+@run_in(index_executor)
+def resume_thread():
+    """Threaded function for resuming interrupted indexing"""
+
+    # tag what's left
+    with index_progress.run(env.music_path):
+        return resume_pending_files()
+
+@run_in(db_executor)
+def pending_thread():
+    """Threaded function for counting files left to index"""
+
+    # count them
+    return count_pending_files()
+
+@run_in(index_executor)
+def duration_thread():
+    """Threaded function for backfilling durations"""
+
+    # read a batch
+    return backfill_durations()
+
+@run_in(index_executor)
+def loudness_thread():
+    """Threaded function for measuring loudness"""
+
+    # measure a batch
+    return measure_loudness()
 
 def poll_new_files(path: str = env.music_path):
     """
-    Gets difference of cached files and current files, then adds new files
-    Returns: Number of files added
+    Syncs the library with the files under a path, retagging changed
+    files and pruning vanished ones
+    Returns: ScanResult with the number of rows changed
     """
 
-    # variable declarations
-    files_changed = 0
-
-    # step 1: get set of files from database
+    # step 1: get known files under path from the database; the range
+    # covers everything starting with "path/", since "0" follows "/"
+    start = time.perf_counter()
+    path = path.rstrip(os.sep)
     with _get_db_conn() as conn:
-        cur = conn.cursor()
-        cur.execute('''
-            SELECT path 
+        cur = conn.execute('''
+            SELECT id, path, size, mtime, inode
                 FROM library
-                WHERE lower(path) LIKE ?;
-            ''', 
-            (str(path + "%"),)
+                WHERE path >= ? AND path < ?;
+            ''',
+            (path + os.sep, path + chr(ord(os.sep) + 1))
+        )
+        known = {row['path']: row for row in cur.fetchall()}
+
+        # and files that couldn't be read last time, by their stats then
+        cur = conn.execute('''
+            SELECT path, size, mtime
+                FROM unreadable
+                WHERE path >= ? AND path < ?;
+            ''',
+            (path + os.sep, path + chr(ord(os.sep) + 1))
         )
-        rows = cur.fetchall()
-    old_files = set([row['path'] for row in rows])
-    
-    # step 2: get set of files from filesystem
-    new_files = set()
-    for entry in os.scandir(path):
-
-        # skip extended attributes and recycle bin; synology thing
-        if "@eaDir" in entry.name or "$RECYCLE.BIN" in entry.name:
+        unreadable = {row['path']: (row['size'], row['mtime']) for row in cur.fetchall()}
+
+    # step 2: stat every file on the filesystem
+    found = {}
+    failed = []
+    _scan_dir(path, found, failed)
+
+    # if the whole library looks empty, it's more likely the mount
+    # dropped out than that every file got deleted. don't prune anything.
+    if not found and known and path == env.music_path.rstrip(os.sep):
+        dbLogger.error(f"No files found under {path}, skipping prune!")
+        failed.append(path)
+
+    # step 3: diff the two, leaving out unreadable files until they change
+    to_be_added = set(
+        file for file in found
+        if file not in known and unreadable.get(file) != found[file][:2]
+    )
+    to_be_removed = {
+        file: row for file, row in known.items()
+        if file not in found and not _is_under(file, failed)
+    }
+    to_be_updated = []
+    to_be_backfilled = {}
+    for file in set(found) & set(known):
+        row = known[file]
+        stat = found[file]
+
+        # rows from before we tracked stats; assume they're current
+        if row['mtime'] is None:
+            to_be_backfilled[row['id']] = stat
+
+        # size or mtime moved, tags may have changed
+        elif (row['size'], row['mtime']) != stat[:2] and \
+            unreadable.get(file) != stat[:2]:
+            to_be_updated.append(file)
+
+    # step 4: pair up removed and added files sharing an inode, size and
+    # mtime; those were moved, so only their path needs updating
+    moved = {}
+    by_inode = {
+        (row['inode'], row['size'], row['mtime']): file
+        for file, row in to_be_removed.items() if row['inode'] is not None
+    }
+    for file in to_be_added:
+        size, mtime, inode = found[file]
+        old = by_inode.pop((inode, size, mtime), None)
+        if old is not None:
+            moved[to_be_removed.pop(old)['id']] = file
+    to_be_added -= set(moved.values())
+
+    # step 5: apply cheap changes first
+    removed_ids = [row['id'] for row in to_be_removed.values()]
+    vanished = [
+        file for file in unreadable
+        if file not in found and not _is_under(file, failed)
+    ]
+    if moved or removed_ids or to_be_backfilled or vanished:
+        with _get_db_writer() as conn:
+            _move_rows(conn, moved)
+            _remove_rows(conn, removed_ids)
+            _backfill_stats(conn, to_be_backfilled)
+            _clear_unreadable(conn, vanished)
+        search_index.remove(removed_ids)
+        search_cache.invalidate()
+
+    # step 6: retag changed files, then add new ones
+    updated = update_files_in_db(to_be_updated)
+    added = add_files_to_db(to_be_added)
+
+    # return what changed, counting only files that could be read
+    index_seconds.observe(time.perf_counter() - start)
+    return ScanResult(
+        added=added,
+        updated=updated + len(moved),
+        removed=len(to_be_removed)
+    )
+
+def sync_paths(paths):
+    """
+    Rescans just the parts of the library containing the given paths
+    Returns: ScanResult with the number of rows changed
+    """
+
+    # scan touched directories themselves; for files, and for anything
+    # that's gone, scan the closest directory that still exists
+    root = env.music_path.rstrip(os.sep)
+    scan_roots = set()
+    for path in paths:
+        path = path.rstrip(os.sep)
+        while not os.path.isdir(path) and path.startswith(root + os.sep):
+            path = os.path.dirname(path)
+        scan_roots.add(path)
+
+    # don't scan a directory twice if its parent is being scanned
+    scan_roots = [
+        path for path in scan_roots
+        if not _is_under(path, scan_roots)
+    ]
+
+    # scan each, adding up the results
+    results = [poll_new_files(path) for path in scan_roots]
+    return ScanResult(*(sum(counts) for counts in zip(*results)))
+
+def _skip_entry(name: str):
+    """Checks whether a directory entry should be left out of scans"""
+
+    # skip extended attributes and recycle bin; synology thing
+    return "@eaDir" in name or "$RECYCLE.BIN" in name
+
+def _list_dir(path: str):
+    """
+    Lists a single directory
+    Returns: Its subdirectories, and a dict of audio file -> stats
+    """
+
+    dirs = []
+    files = {}
+    with os.scandir(path) as it:
+        for entry in it:
+
+            # skip junk
+            if _skip_entry(entry.name):
+                continue
+
+            # if directory, hand it back to be listed
+            if entry.is_dir():
+                dirs.append(entry.path)
+
+            # if audio file, grab its stats, unless it just vanished
+            elif entry.is_file() and entry.name.lower().endswith(AUDIO_EXTENSIONS):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files[entry.path] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+    return dirs, files
+
+def _scan_dir(path: str, found: dict, failed: list):
+    """
+    Stats the audio files within a directory tree, listing several
+    directories at once; on network mounts each listing is a round trip
+    """
+
+    # walk iteratively, deep libraries shouldn't hit the recursion limit;
+    # listings run on the scan pool, sized to what the mount can take
+    pending = {scan_executor.submit(_list_dir, path): path}
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            current = pending.pop(future)
+
+            # if a directory can't be listed, note it so its rows are kept
+            try:
+                dirs, files = future.result()
+            except OSError as e:
+                dbLogger.error(f"Couldn't scan {current}: {e}")
+                failed.append(current)
+                continue
+
+            # merge its files, and queue up its subdirectories
+            found.update(files)
+            index_progress.walked(len(files))
+            for subdir in dirs:
+                pending[scan_executor.submit(_list_dir, subdir)] = subdir
+
+def count_pending_files():
+    """Gets the number of files an interrupted index never got to"""
+
+    with _get_db_conn() as conn:
+        return conn.execute('SELECT count(*) FROM pending;').fetchone()[0]
+
+def resume_pending_files():
+    """
+    Tags the files an interrupted index never got to, from its checkpoint
+    Returns: ScanResult with the number of rows changed
+    """
+
+    # get what's left, forgetting files that vanished meanwhile
+    with _get_db_conn() as conn:
+        cur = conn.execute('SELECT path FROM pending;')
+        files = [row['path'] for row in cur.fetchall()]
+    gone = [file for file in files if not os.path.isfile(file)]
+    if gone:
+        with _get_db_writer() as conn:
+            _clear_pending(conn, gone)
+            conn.commit()
+
+    # then carry on where it stopped
+    remaining = sorted(set(files) - set(gone))
+    dbLogger.warning(f"Resuming indexing, {len(remaining)} files left...")
+    return ScanResult(added=add_files_to_db(remaining))
+
+def _queue_pending(conn, files: list):
+    """Checkpoints files about to be tagged, so a restart can resume them"""
+
+    conn.executemany(
+        'INSERT OR IGNORE INTO pending(path) VALUES(?);',
+        [(file,) for file in files]
+    )
+
+def _clear_pending(conn, files: list):
+    """Marks files as tagged, or no longer worth tagging"""
+
+    conn.executemany(
+        'DELETE FROM pending WHERE path = ?;',
+        [(file,) for file in files]
+    )
+
+def _mark_unreadable(conn, files: list):
+    """Records files whose tags couldn't be read, by their current stats"""
+
+    rows = []
+    for file in files:
+        try:
+            stat = os.stat(file)
+        except OSError:
             continue
+        rows.append((file, stat.st_size, stat.st_mtime_ns))
+    conn.executemany(
+        'INSERT OR REPLACE INTO unreadable(path, size, mtime) VALUES(?, ?, ?);',
+        rows
+    )
+
+def _clear_unreadable(conn, files: list):
+    """Forgets files were unreadable, once read or gone"""
+
+    conn.executemany(
+        'DELETE FROM unreadable WHERE path = ?;',
+        [(file,) for file in files]
+    )
+
+def _is_under(file: str, dirs: list):
+    """Checks whether a file lives within any of the given directories"""
+
+    return any(file.startswith(d + os.sep) for d in dirs)
+
+def _move_rows(conn, moved: dict):
+    """Points rows at the new paths of moved files"""
+
+    if not moved:
+        return
+    conn.executemany(
+        'UPDATE library SET path = ? WHERE id = ?;',
+        [(file, row_id) for row_id, file in moved.items()]
+    )
+    _bump_generation(conn)
+
+def _remove_rows(conn, row_ids: list):
+    """Deletes rows, keeping the full text index in sync"""
+
+    if not row_ids:
+        return
+    _delete_rows(conn, row_ids)
+    _bump_generation(conn)
+
+def _delete_rows(conn, row_ids: list):
+    """Deletes rows and their full text entries"""
+
+    # drop them from the search index, while we still have their values
+    params = [(row_id,) for row_id in row_ids]
+    conn.executemany('''INSERT INTO library_fts(library_fts, rowid, title, artist, album)
+        SELECT 'delete', id, title, artist, album FROM library WHERE id = ?;''',
+        params
+    )
+
+    # then from the library
+    conn.executemany('DELETE FROM library WHERE id = ?;', params)
+
+def _backfill_stats(conn, stats: dict):
+    """Records file stats for rows indexed before we tracked them"""
+
+    conn.executemany(
+        'UPDATE library SET size = ?, mtime = ?, inode = ? WHERE id = ?;',
+        [(*stat, row_id) for row_id, stat in stats.items()]
+    )
+
+def _read_tags(file: str):
+    """Reads a file's tags; runs inside the indexer's worker processes"""
+
+    # a single unreadable file shouldn't sink the whole batch
+    try:
+        stat = os.stat(file)
+        tag = TinyTag.get(file)
+    except Exception as e:
+        return file, f"{type(e).__name__} - {e}"
+
+    # return a row, ready to be written
+    return file, (
+        tag.title,
+        tag.artist,
+        tag.album,
+        tag.track,
+        tag.disc,
+        tag.duration or 0.0,
+        stat.st_size,
+        stat.st_mtime_ns,
+        stat.st_ino,
+        file
+    )
+
+def _tag_files(file_list, write_chunk):
+    """
+    Reads tags across a process pool, handing rows off in chunks
+    Returns: Number of rows written
+    """
 
-        # if directory, step into it
-        if entry.is_dir():
-            files_changed += poll_new_files(entry.path)
-
-        # if file, add to set
-        if entry.is_file(): 
-            filename = os.path.basename(entry.path)
-            if filename.lower().endswith(".mp3") or \
-                filename.lower().endswith(".flac") or \
-                filename.lower().endswith(".wav"):
-                new_files.add(entry.path)
-
-    # step 3: find new files
-    to_be_added = new_files - old_files
-
-    # step 4: add new files to database
-    if len(to_be_added) > 0:
-        add_files_to_db(to_be_added)
-        return len(to_be_added) + files_changed
-    else:
+    # sort so files in the same folder get read together
+    files = sorted(file_list)
+    if not files:
         return 0
+    start = time.perf_counter()
+
+    # checkpoint everything up front; each chunk clears its own files
+    # in the transaction that writes them, so a restart resumes from
+    # the first chunk that didn't commit
+    with _get_db_writer() as conn:
+        _queue_pending(conn, files)
+        conn.commit()
+    index_progress.tagging(len(files))
+
+    # small batches aren't worth spinning up a pool for
+    workers = min(env.index_workers, len(files) // SMALL_BATCH)
+    pool = InstrumentedProcessExecutor('tag', workers) if workers > 1 else None
+    try:
+
+        # fan tag reads out, results come back in order
+        if pool:
+            results = pool.map(_read_tags, files, chunksize=64)
+        else:
+            results = map(_read_tags, files)
+
+        # write rows out one chunk at a time, only holding on to
+        # the writer while a chunk is being written; unreadable files
+        # are recorded, so scans skip them until they change
+        written = 0
+        chunk = []
+        failures = []
+        done = []
+        for file, row in results:
+            done.append(file)
+            index_progress.tagged()
+            if isinstance(row, str):
+                dbLogger.error(f"Couldn't read tags of {file}: {row}")
+                failures.append(file)
+            else:
+                chunk.append(row)
+            if len(done) >= env.index_chunk_size:
+                with _get_db_writer() as conn:
+                    _clear_pending(conn, done)
+                    _clear_unreadable(conn, done)
+                    _mark_unreadable(conn, failures)
+                    write_chunk(conn, chunk)
+                written += len(chunk)
+                chunk = []
+                failures = []
+                done = []
+
+        # write whatever's left
+        if done:
+            with _get_db_writer() as conn:
+                _clear_pending(conn, done)
+                _clear_unreadable(conn, done)
+                _mark_unreadable(conn, failures)
+                write_chunk(conn, chunk)
+            written += len(chunk)
+
+    # always clean up the pool
+    finally:
+        if pool:
+            pool.shutdown()
+
+    # report throughput
+    elapsed = time.perf_counter() - start
+    index_files.inc(len(files))
+    index_files_per_second.set(len(files) / elapsed)
+    dbLogger.info(
+        f"Tagged {len(files)} files in {elapsed:.2f}s " + \
+        f"({len(files) / elapsed:.1f} files/s, {max(workers, 1)} workers)"
+    )
+    return written
+
+def _insert_rows(conn, rows):
+    """Upserts a chunk of rows by path, keeping both search indexes in sync"""
+
+    # note where this chunk starts, ids only ever grow
+    last_id = conn.execute('SELECT max(id) FROM library;').fetchone()[0] or 0
+
+    # find rows these files already have, as (id, title, artist)
+    existing = []
+    for row in rows:
+        found = conn.execute(
+            'SELECT id FROM library WHERE path = ?;', (row[-1],)
+        ).fetchone()
+        if found is not None:
+            existing.append((found['id'], row[0], row[1]))
+    params = [(update[0],) for update in existing]
+
+    # drop their old values from the search index
+    conn.executemany('''INSERT INTO library_fts(library_fts, rowid, title, artist, album)
+        SELECT 'delete', id, title, artist, album FROM library WHERE id = ?;''',
+        params
+    )
+
+    # insert file info, or update it in place for known paths; the
+    # audio may have changed too, so it needs measuring again
+    conn.executemany('''INSERT INTO library(title, artist, album, tracknum, discnum, duration, size, mtime, inode, path)
+        VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(path) DO UPDATE SET title = excluded.title,
+            artist = excluded.artist, album = excluded.album,
+            tracknum = excluded.tracknum, discnum = excluded.discnum,
+            duration = excluded.duration, size = excluded.size,
+            mtime = excluded.mtime, inode = excluded.inode, gain = NULL''',
+        rows
+    )
+
+    # index the new values, of both new and updated rows
+    conn.execute('''INSERT INTO library_fts(rowid, title, artist, album)
+        SELECT id, title, artist, album FROM library WHERE id > ?;''',
+        (last_id,)
+    )
+    conn.executemany('''INSERT INTO library_fts(rowid, title, artist, album)
+        SELECT id, title, artist, album FROM library WHERE id = ?;''',
+        params
+    )
+
+    # commit changes, bounding the transaction to this chunk
+    if rows:
+        _bump_generation(conn)
+    conn.commit()
+
+    # swap the rows in the fuzzy index too
+    search_index.remove(update[0] for update in existing)
+    search_index.add(existing)
+    cur = conn.execute(
+        'SELECT id, title, artist FROM library WHERE id > ?;',
+        (last_id,)
+    )
+    search_index.add(tuple(row) for row in cur)
+
+    # both indexes are up to date, cached results aren't
+    search_cache.invalidate()
 
 def add_files_to_db(file_list):
-    """Iterates thru lists and adds file to db"""
+    """
+    Reads tags across a process pool and adds files to db in chunks
+    Returns: Number of files added
+    """
 
-    # connect to database
+    return _tag_files(file_list, _insert_rows)
+
+def update_files_in_db(file_list):
+    """
+    Re-reads tags of changed files, updating their rows in place
+    Returns: Number of files updated
+    """
+
+    return _tag_files(file_list, _insert_rows)
+
+def backfill_durations(limit: int = DURATION_BATCH):
+    """
+    Reads the durations of tracks indexed before durations were stored,
+    without retagging them
+    Returns: Number of tracks read
+    """
+
+    # get a batch of tracks without one
     with _get_db_conn() as conn:
+        rows = conn.execute(
+            'SELECT id, path FROM library WHERE duration IS NULL LIMIT ?;',
+            (limit,)
+        ).fetchall()
+    if not rows:
+        return 0
 
-        # iterate files
-        for file in file_list:
-
-            # get file info
-            tag = TinyTag.get(file)
-
-            # insert file info
-            conn.execute('''INSERT INTO library(title, artist, album, tracknum, discnum, path)
-                VALUES(?, ?, ?, ?, ?, ?)''',
-                (
-                    tag.title,
-                    tag.artist,
-                    tag.album,
-                    tag.track,
-                    tag.disc,
-                    file
-                )
-            )
+    # read them; files that can't be read count as zero length, and
+    # aren't retried until they change
+    durations = []
+    for row in rows:
+        try:
+            duration = TinyTag.get(row['path'], tags=False).duration or 0.0
+        except Exception:
+            duration = 0.0
+        durations.append((duration, row['id']))
 
-        # commit changes
-        conn.commit()
+    # store them, unless a retag got there first with fresher ones
+    with _get_db_writer() as conn:
+        conn.executemany(
+            'UPDATE library SET duration = ? WHERE id = ? AND duration IS NULL;',
+            durations
+        )
+    search_cache.invalidate()
+
+    return len(rows)
+
+def measure_loudness(limit: int = LOUDNESS_BATCH):
+    """
+    Measures the loudness of tracks that haven't been yet, storing the
+    gain that normalizes each one
+    Returns: Number of tracks measured
+    """
+
+    # get a batch of unmeasured tracks
+    with _get_db_conn() as conn:
+        rows = conn.execute(
+            'SELECT id, path, mtime FROM library WHERE gain IS NULL LIMIT ?;',
+            (limit,)
+        ).fetchall()
+    if not rows:
+        return 0
+
+    # measure them on the transcode pool, alongside cache fills
+    gains = transcode_executor.map(measure_gain, [row['path'] for row in rows])
+
+    # store them; files ffmpeg can't read play as they are, and aren't
+    # retried until they change. files retagged while we measured have
+    # a new mtime, and their new audio gets measured next pass instead
+    with _get_db_writer() as conn:
+        conn.executemany(
+            'UPDATE library SET gain = ? ' + \
+                'WHERE id = ? AND mtime IS ? AND gain IS NULL;',
+            [(0.0 if gain is None else gain, row['id'], row['mtime'])
+                for gain, row in zip(gains, rows)]
+        )
+
+    return len(rows)
+
+def _fts_query(query: str):
+    """Turns a user query into an FTS5 match expression"""
+
+    # split into words, quoting each so FTS5 syntax can't leak in,
+    # and prefix match them so partially typed words still hit
+    terms = re.findall(r"\w+", query.lower())
+    return " ".join(f'"{term}"*' for term in terms)
 
 def search_db(query: str):
     """Searches Database"""
 
+    # build match expression, bail if there's nothing to match
+    start = time.perf_counter()
+    match = _fts_query(query)
+    if not match:
+        return []
+
+    # answer repeat queries from the cache, unless the library changed
+    # since, even in another process; hand out copies, since callers
+    # tack things onto the entries
+    search_cache.sync(library_generation())
+    key = search_cache.normalize(query)
+    cached = search_cache.get(key)
+    if cached is not None:
+        search_cache_hits.inc()
+        search_seconds.observe(time.perf_counter() - start)
+        search_results.observe(len(cached))
+        return [dict(row) for row in cached]
+    search_cache_misses.inc()
+
+    # note the generation first, so results racing a library change
+    # don't get cached
+    generation = search_cache.generation
+
     # connect to database
     with _get_db_conn() as conn:
 
-        # get results
+        # get exact word matches, best matches first
         cur = conn.cursor()
         cur.execute('''
-        SELECT * FROM library WHERE lower(title) LIKE ?;
+        SELECT library.* FROM library_fts
+            JOIN library ON library.id = library_fts.rowid
+            WHERE library_fts MATCH ?
+            ORDER BY bm25(library_fts, ?, ?, ?)
+            LIMIT ?;
         ''',
             (
-                '%' + query.lower() + '%',
+                match,
+                *BM25_WEIGHTS,
+                SEARCH_LIMIT
             )
         )
 
-        # sort results
         results = [dict(row) for row in cur.fetchall()]
-        results.sort(
-            key=lambda x: difflib.SequenceMatcher(
-                None, query.lower(), 
-                x['title'].lower()
-            ).ratio(), 
-            reverse=True
+
+        # top up with near misses, so typos still find something
+        if len(results) < SEARCH_LIMIT:
+            seen = set(row['id'] for row in results)
+            near = [
+                row_id for row_id in search_index.search(query, SEARCH_LIMIT * 2)
+                if row_id not in seen
+            ][:SEARCH_LIMIT - len(results)]
+
+            # fetch those rows, keeping the index's order
+            if near:
+                cur.execute(
+                    'SELECT * FROM library WHERE id IN (' + \
+                        ', '.join('?' * len(near)) + ');',
+                    near
+                )
+                rows = {row['id']: dict(row) for row in cur.fetchall()}
+                results += [rows[row_id] for row_id in near if row_id in rows]
+
+        # cache and return results
+        search_cache.put(key, generation, [dict(row) for row in results])
+        search_seconds.observe(time.perf_counter() - start)
+        search_results.observe(len(results))
+        return results
+
+
+def lookup_album_db(query: str):
+    """
+    Finds the album best matching a query, by album and artist name
+    Returns: List of the album's tracks, in disc and track order
+    """
+
+    # build match expression, bail if there's nothing to match
+    match = _fts_query(query)
+    if not match:
+        return []
+
+    # connect to database
+    with _get_db_conn() as conn:
+
+        # pick the best matching album, skipping rows that only matched
+        # on an artist without one, then get all of its tracks through
+        # the album index, in one go; compilations have a track artist
+        # per song, so the album name alone picks the tracks
+        cur = conn.execute('''
+        WITH best AS (
+            SELECT library.album FROM library_fts
+                JOIN library ON library.id = library_fts.rowid
+                WHERE library_fts MATCH ?
+                    AND library.album IS NOT NULL AND library.album != ''
+                ORDER BY bm25(library_fts, ?, ?, ?)
+                LIMIT 1
+        )
+        SELECT library.* FROM best
+            JOIN library ON library.album = best.album COLLATE NOCASE
+            ORDER BY library.album COLLATE NOCASE, library.discnum,
+                library.tracknum;
+        ''',
+            (
+                "{album artist} : (" + match + ")",
+                *BM25_WEIGHTS
+            )
+        )
+
+        # return results
+        return [dict(row) for row in cur.fetchall()]
+
+def lookup_artist_db(query: str):
+    """
+    Finds the artist best matching a query
+    Returns: List of the artist's tracks, by album then disc and track
+    """
+
+    # build match expression, bail if there's nothing to match
+    match = _fts_query(query)
+    if not match:
+        return []
+
+    # connect to database
+    with _get_db_conn() as conn:
+
+        # pick the best matching artist, then get all of their tracks
+        # through the artist index, in one go
+        cur = conn.execute('''
+        WITH best AS (
+            SELECT library.artist FROM library_fts
+                JOIN library ON library.id = library_fts.rowid
+                WHERE library_fts MATCH ?
+                ORDER BY bm25(library_fts, ?, ?, ?)
+                LIMIT 1
+        )
+        SELECT library.* FROM best
+            JOIN library ON library.artist = best.artist COLLATE NOCASE
+            ORDER BY library.album COLLATE NOCASE, library.discnum,
+                library.tracknum;
+        ''',
+            (
+                "{artist} : (" + match + ")",
+                *BM25_WEIGHTS
+            )
         )
 
         # return results
-        return results[:9]
+        return [dict(row) for row in cur.fetchall()]
+
+def lookup_db(row_id: int):
+    """Gets a single library row by id"""
+
+    # connect to database
+    with _get_db_conn() as conn:
+
+        # get row
+        cur = conn.execute('SELECT * FROM library WHERE id = ?;', (row_id,))
+        row = cur.fetchone()
+
+        # return it, if it exists
+        return dict(row) if row else None
+
+@run_in(db_executor)
+def search_thread(query: str):
+    """Threaded function for searching the database"""
+
+    # search
+    return search_db(query)
+
+@run_in(db_executor)
+def album_thread(query: str):
+    """Threaded function for looking up an album"""
+
+    # lookup
+    return lookup_album_db(query)
+
+@run_in(db_executor)
+def artist_thread(query: str):
+    """Threaded function for looking up an artist"""
+
+    # lookup
+    return lookup_artist_db(query)
+
+@run_in(db_executor)
+def lookup_thread(row_id: int):
+    """Threaded function for looking up a library row"""
+
+    # lookup
+    return lookup_db(row_id)
@@ -1,3 +1,4 @@
+import time
 import discord
 import logging
 from enum import Enum
@@ -5,10 +6,15 @@ from datetime import datetime
 from discord.ext import commands
 
 from .env import env
+from .metrics import MetricsServer, command_seconds, command_errors, voice_clients
+from .profiling import profiler
+from .db import db_conns
+from .util.threading import shutdown_executors
 
 cogs = [
     "nyxbot.cogs.music",
     "nyxbot.cogs.dbadmin",
+    "nyxbot.cogs.diagnostics",
 ]
 
 botLogger = logging.getLogger('NyxBot.bot')
@@ -28,7 +34,7 @@ class EmbedColors(int, Enum):
     LIGHT = int(0xe2e6ea)
     DARK = int(0x23272b)
 
-class SMBot(commands.Bot):
+class SMBot(commands.AutoShardedBot):
     """Custom Discord Bot"""
 
     def __init__(self, *args, **kwargs):
@@ -36,16 +42,51 @@ class SMBot(commands.Bot):
         for cog in cogs:
             self.load_extension(cog)
 
+        # metrics, served if enabled
+        self.metrics_server = None
+        voice_clients.set_function(lambda: {(): len(self.voice_clients)})
+
+    async def start(self, *args, **kwargs):
+        """Starts the metrics endpoint, if enabled, then the bot"""
+
+        if env.metrics_port:
+            self.metrics_server = MetricsServer(env.metrics_host, env.metrics_port)
+            await self.metrics_server.start()
+        await super().start(*args, **kwargs)
+
+    async def invoke(self, ctx):
+        """Runs a command, timing it and profiling it if it runs slow"""
+
+        # nothing to time
+        if ctx.command is None:
+            return await super().invoke(ctx)
+
+        start = time.perf_counter()
+        try:
+            with profiler.watch(ctx.command.qualified_name, repr(ctx.message.content)):
+                await super().invoke(ctx)
+        finally:
+            command_seconds.observe(
+                time.perf_counter() - start,
+                command=ctx.command.qualified_name
+            )
+
     async def on_ready(self):
         """Event: Bot is ready"""
 
         # log ready
-        botLogger.info(f"Logged in as {self.user}")
+        botLogger.info(f"Logged in as {self.user} (shards {self.shard_ids})")
+
+        # only one worker announces itself when sharded
+        if not env.run_indexer:
+            return
 
-        # send embed
+        # send embed; the admin channel may belong to another worker's
+        # shards, so fall back to fetching it over http
         # sorry for this mess lol
-        await self.get_channel(env.admin_channel) \
-            .send(embed=discord.Embed(
+        channel = self.get_channel(env.admin_channel) or \
+            await self.fetch_channel(env.admin_channel)
+        await channel.send(embed=discord.Embed(
                 description = "Started up at " + \
                     datetime.now().strftime("%m/%d/%Y, %H:%M:%S") + \
                     "! :white_check_mark:",
@@ -56,15 +97,32 @@ class SMBot(commands.Bot):
         """Event: Close the bot"""
 
         # disconnect from all voice clients
-        for vc in bot.voice_clients:
+        for vc in self.voice_clients:
             await vc.disconnect()
-        
+
+        # log out for real
+        await super().close()
+
+        # stop serving metrics
+        if self.metrics_server:
+            await self.metrics_server.stop()
+
+        # stop the worker pools, dropping anything still queued, then
+        # close every database connection
+        shutdown_executors()
+        db_conns.close()
+
         # log close
-        botLogger.info(f'Logged out of {bot.user}!')
+        botLogger.info(f'Logged out of {self.user}!')
 
     async def on_command_error(self, ctx, error):
         """Event: Error in command"""
 
+        # count it
+        command_errors.inc(
+            command=ctx.command.qualified_name if ctx.command else ""
+        )
+
         # if command isn't found
         if isinstance(error, commands.CommandNotFound):
             await ctx.send(embed=discord.Embed(
@@ -92,14 +150,19 @@ class SMBot(commands.Bot):
             ))
             botLogger.error(f"Error in command {ctx.command}: {error}")
 
-intents = discord.Intents.default()
-status = discord.Game(
-    name="with my big nuts"
-)
-bot = SMBot(
-    command_prefix=commands.when_mentioned_or(">"),
-    description='Relatively simple music bot example',
-    help_command=commands.DefaultHelpCommand(),
-    intents=intents,
-    activity=status
-)
+def create_bot(shard_ids: list = None, shard_count: int = None):
+    """Creates the bot, optionally running just a subset of shards"""
+
+    intents = discord.Intents.default()
+    status = discord.Game(
+        name="with my big nuts"
+    )
+    return SMBot(
+        command_prefix=commands.when_mentioned_or(">"),
+        description='Relatively simple music bot example',
+        help_command=commands.DefaultHelpCommand(),
+        intents=intents,
+        activity=status,
+        shard_ids=shard_ids,
+        shard_count=shard_count
+    )
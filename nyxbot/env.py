@@ -33,6 +33,84 @@ class EnvDict():
         self.admin_channel = int(self.admin_channel) \
             if self.admin_channel.isnumeric() else None
 
+        # indexer worker processes, defaults to one per core
+        _env_workers = os.getenv('INDEX_WORKERS')
+        self.index_workers = int(_env_workers) \
+            if _env_workers else os.cpu_count()
+
+        # files written to the library per transaction
+        _env_chunk = os.getenv('INDEX_CHUNK_SIZE')
+        self.index_chunk_size = int(_env_chunk) if _env_chunk else 500
+
+        # minutes between full library scans
+        _env_interval = os.getenv('SCAN_INTERVAL')
+        self.scan_interval = float(_env_interval) if _env_interval else 30
+
+        # watch the library for changes between full scans
+        self.watch_library = os.getenv('WATCH_LIBRARY', '').lower() \
+            in ('1', 'true', 'yes')
+
+        # seconds of quiet before watched changes get indexed
+        _env_debounce = os.getenv('WATCH_DEBOUNCE')
+        self.watch_debounce = float(_env_debounce) if _env_debounce else 5
+
+        # sqlite tuning; cache size is in KiB, mmap size in bytes
+        self.db_synchronous = os.getenv('DB_SYNCHRONOUS', 'NORMAL').upper()
+        self.db_cache_size = int(os.getenv('DB_CACHE_SIZE', 65536))
+        self.db_mmap_size = int(os.getenv('DB_MMAP_SIZE', 268435456))
+        self.db_busy_timeout = float(os.getenv('DB_BUSY_TIMEOUT', 30))
+        self.db_statement_cache = int(os.getenv('DB_STATEMENT_CACHE', 256))
+
+        # directories listed at once while scanning; raise it for network
+        # mounts, where listings wait on latency rather than disk
+        self.scan_workers = max(1, int(os.getenv('SCAN_WORKERS', 4)))
+
+        # threads for scans and library upkeep; scans take turns, so
+        # past the first the rest keep loudness and refreshes moving
+        self.index_threads = max(1, int(os.getenv('INDEX_THREADS', 2)))
+
+        # threads serving database queries for the bot
+        self.db_workers = int(os.getenv('DB_WORKERS', 4))
+
+        # shard worker processes; one means no sharding, like before
+        self.shard_processes = int(os.getenv('SHARD_PROCESSES', 1))
+
+        # total shards spread across the workers
+        _env_shards = os.getenv('SHARD_COUNT')
+        self.shard_count = int(_env_shards) \
+            if _env_shards else self.shard_processes
+
+        # whether this process indexes the library; shard workers
+        # other than the first only read from it
+        self.run_indexer = True
+
+        # opus cache budget in MiB, zero turns it off
+        self.opus_cache_size = int(os.getenv('OPUS_CACHE_SIZE', 1024))
+
+        # bitrate of cached opus files, in kbps
+        self.opus_bitrate = int(os.getenv('OPUS_BITRATE', 128))
+
+        # concurrent ffmpeg transcodes
+        self.transcode_workers = int(os.getenv('TRANSCODE_WORKERS', 1))
+
+        # loudness tracks are normalized to, in LUFS
+        self.loudness_target = float(os.getenv('LOUDNESS_TARGET', -18))
+
+        # songs a guild can queue, zero for no limit
+        self.queue_limit = int(os.getenv('QUEUE_LIMIT', 10000))
+
+        # search queries whose results are cached
+        self.search_cache_size = int(os.getenv('SEARCH_CACHE_SIZE', 256))
+
+        # local metrics endpoint, off unless a port is given
+        self.metrics_host = os.getenv('METRICS_HOST', '127.0.0.1')
+        self.metrics_port = int(os.getenv('METRICS_PORT', 0))
+
+        # commands slower than this get logged, and a fraction of all
+        # commands get profiled in case they turn out slow
+        self.slow_command_ms = float(os.getenv('SLOW_COMMAND_MS', 1000))
+        self.profile_sample_rate = float(os.getenv('PROFILE_SAMPLE_RATE', 0.05))
+
         # first run
         self.first_run = not os.path.exists(
             os.path.join(self.config_path, DB_NAME)
@@ -0,0 +1,291 @@
+import math
+import time
+import bisect
+import logging
+import threading
+import contextlib
+from aiohttp import web
+
+metricsLogger = logging.getLogger('NyxBot.metrics')
+
+# default histogram buckets, in seconds
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+# buckets for things that take minutes rather than milliseconds
+DURATION_BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+def _format_value(value: float):
+    """Formats a sample value the way prometheus expects"""
+
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+def _format_labels(labels: dict):
+    """Formats a label set, escaping values"""
+
+    if not labels:
+        return ""
+    return "{" + ",".join(
+        f'{name}="' + str(value).replace("\\", "\\\\") \
+            .replace("\n", "\\n").replace('"', '\\"') + '"'
+        for name, value in labels.items()
+    ) + "}"
+
+class Registry():
+    """Collection of metrics, rendered together"""
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({len(self._metrics)} metrics)"
+
+    def __init__(self):
+        self._metrics = []
+
+    def add(self, metric):
+        """Registers a metric"""
+
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Renders every metric in prometheus' text format"""
+
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+class Metric():
+    """Base metric: a name, help text and label names"""
+
+    kind = "untyped"
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.name})"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+        # label values -> value; samples come from several threads
+        self._lock = threading.Lock()
+        self._values = {}
+
+        # optional callback computing values at scrape time
+        self._function = None
+
+        registry.add(self)
+
+    def _key(self, labels: dict):
+        """Gets the key of a label set, in label name order"""
+
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def set_function(self, function):
+        """
+        Computes the metric when scraped instead, from a function returning
+        a dict of label value tuples -> value
+        """
+
+        self._function = function
+
+    def _items(self):
+        """Gets (label values, value) pairs, calling the function if set"""
+
+        if self._function is not None:
+            try:
+                return list(self._function().items())
+            except Exception as e:
+                metricsLogger.error(f"Couldn't collect {self.name}: {e}")
+                return []
+        with self._lock:
+            return list(self._values.items())
+
+    def _samples(self, key: tuple, value):
+        """Gets (suffix, labels, value) samples for a single label set"""
+
+        return [("", dict(zip(self.labels, key)), value)]
+
+    def render(self):
+        """Renders the metric in prometheus' text format"""
+
+        lines = [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for key, value in sorted(self._items()):
+            for suffix, labels, sample in self._samples(key, value):
+                lines.append(
+                    f"{self.name}{suffix}{_format_labels(labels)} " + \
+                    _format_value(sample)
+                )
+        return lines
+
+class Counter(Metric):
+    """Metric that only ever goes up"""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        """Adds to the counter"""
+
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+class Gauge(Metric):
+    """Metric that can go up and down"""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        """Sets the gauge"""
+
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+class Histogram(Metric):
+    """Metric counting observations into buckets"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (),
+        buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        """Records an observation"""
+
+        # values are (per bucket counts, sum, count)
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total, count = self._values.get(
+                key, ([0] * (len(self.buckets) + 1), 0.0, 0)
+            )
+            counts[index] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observes how long the block inside takes"""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self, key: tuple, value):
+        counts, total, count = value
+        labels = dict(zip(self.labels, key))
+
+        # buckets are cumulative, ending in +Inf
+        samples = []
+        cumulative = 0
+        for bound, bucket in zip(self.buckets + (math.inf,), counts):
+            cumulative += bucket
+            samples.append(("_bucket", {**labels, "le": _format_value(bound)}, cumulative))
+        samples.append(("_sum", labels, total))
+        samples.append(("_count", labels, count))
+        return samples
+
+class MetricsServer():
+    """Serves the registry over http, from the bot's own event loop"""
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.host}:{self.port})"
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def start(self):
+        """Starts serving /metrics"""
+
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        metricsLogger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        """Stops serving"""
+
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle(self, request):
+        """Handler: renders the registry"""
+
+        return web.Response(
+            body=registry.render().encode('utf-8'),
+            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+        )
+
+#
+# ===== [ Metrics ] =====
+#
+
+command_seconds = Histogram(
+    'nyxbot_command_seconds', "Time taken to run commands", ('command',)
+)
+command_errors = Counter(
+    'nyxbot_command_errors_total', "Commands that failed", ('command',)
+)
+search_seconds = Histogram(
+    'nyxbot_search_seconds', "Time taken to search the library"
+)
+search_cache_hits = Counter(
+    'nyxbot_search_cache_hits_total', "Searches answered from the cache"
+)
+search_cache_misses = Counter(
+    'nyxbot_search_cache_misses_total', "Searches that had to query the library"
+)
+search_cache_size = Gauge(
+    'nyxbot_search_cache_size', "Queries currently cached"
+)
+search_results = Histogram(
+    'nyxbot_search_results', "Results returned per search",
+    buckets=tuple(range(10))
+)
+index_seconds = Histogram(
+    'nyxbot_index_seconds', "Time taken by library scans",
+    buckets=DURATION_BUCKETS
+)
+index_files = Counter(
+    'nyxbot_index_files_total', "Files tagged by the indexer"
+)
+index_files_per_second = Gauge(
+    'nyxbot_index_files_per_second', "Tagging throughput of the last indexing batch"
+)
+queue_depth = Gauge(
+    'nyxbot_queue_depth', "Songs queued per guild", ('guild',)
+)
+ffmpeg_spawn_seconds = Histogram(
+    'nyxbot_ffmpeg_spawn_seconds', "Time taken to start ffmpeg for playback",
+    ('cached',)
+)
+voice_clients = Gauge(
+    'nyxbot_voice_clients', "Voice channels the bot is connected to"
+)
+executor_queued = Gauge(
+    'nyxbot_executor_queued', "Calls waiting for a thread, per executor", ('executor',)
+)
+executor_active = Gauge(
+    'nyxbot_executor_active', "Calls running, per executor", ('executor',)
+)
+executor_wait_seconds = Histogram(
+    'nyxbot_executor_wait_seconds', "Time calls spent waiting for a thread",
+    ('executor',)
+)
@@ -0,0 +1,559 @@
+import time
+import random
+import asyncio
+import discord
+import logging
+import threading
+import collections
+from typing import Optional
+from async_timeout import timeout
+
+from .env import env
+from .db import lookup_thread
+from .metrics import ffmpeg_spawn_seconds
+from .transcode import opus_cache
+from .tracing import null_trace
+from .util.threading import to_thread, blocking_executor
+
+playerLogger = logging.getLogger('NyxBot.player')
+
+# length of a frame of audio
+FRAME_SECONDS = 0.02
+
+# frames read ahead for the next song, i.e. two seconds
+PREFETCH_FRAMES = 100
+
+def _cleanup_later(source: discord.AudioSource):
+    """
+    Cleans a source up off the event loop; ffmpeg stuck on a cold
+    network read can take a while to die
+    """
+
+    # once the pools are shut down, we're exiting anyway
+    try:
+        blocking_executor.submit(source.cleanup)
+    except RuntimeError:
+        source.cleanup()
+
+class PrefetchedSource(discord.AudioSource):
+    """Audio source which reads ahead the start of another in the background"""
+
+    def __init__(self, original: discord.AudioSource, frames: int = PREFETCH_FRAMES):
+        self.original = original
+
+        # frames read so far, and whether the reader is done
+        self._buffer = collections.deque()
+        self._filled = threading.Event()
+        self._stopping = False
+
+        # read ahead on our own thread, so cold network reads and
+        # ffmpeg's startup happen before we're asked for audio
+        self._reader = threading.Thread(
+            target=self._fill, args=(frames,), daemon=True
+        )
+        self._reader.start()
+
+    def _fill(self, frames: int):
+        """Reads ahead the first frames of the source"""
+
+        try:
+            for _ in range(frames):
+                if self._stopping:
+                    break
+                frame = self.original.read()
+                self._buffer.append(frame)
+                if not frame:
+                    break
+
+        # the source was cleaned up underneath us
+        except (OSError, ValueError):
+            pass
+        finally:
+            self._filled.set()
+
+    def read(self):
+
+        # hand out what we read ahead, waiting for the reader to finish
+        # before touching the source ourselves
+        if not self._buffer:
+            self._filled.wait()
+        if self._buffer:
+            return self._buffer.popleft()
+        return self.original.read()
+
+    def is_opus(self):
+        return self.original.is_opus()
+
+    def cleanup(self):
+
+        # stop the reader; cleaning up the source first unblocks any
+        # read it's stuck in
+        self._stopping = True
+        self.original.cleanup()
+        self._filled.wait()
+
+class TrackedSource(discord.AudioSource):
+    """Audio source which keeps track of how far into the song it is"""
+
+    def __init__(self, original: discord.AudioSource, start: float = 0.0):
+        self.original = original
+        self.start = start
+        self.frames = 0
+
+        # called from the voice thread once the first frame is read
+        self.on_first_frame = None
+
+    @property
+    def position(self):
+        """Seconds into the song"""
+
+        return self.start + self.frames * FRAME_SECONDS
+
+    def read(self):
+        frame = self.original.read()
+        if frame:
+            self.frames += 1
+            if self.frames == 1 and self.on_first_frame:
+                self.on_first_frame()
+        return frame
+
+    def is_opus(self):
+        return self.original.is_opus()
+
+    def cleanup(self):
+        self.original.cleanup()
+
+class SongQueue(asyncio.Queue):
+    """
+    Custom implementation of queue with helper functions for songs; backed
+    by a deque, with the total duration of queued songs kept up to date
+    """
+
+    def __init__(self, *args, on_change=None, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # called whenever songs are added or the order changes
+        self.on_change = on_change
+
+        # seconds of queued songs, adjusted as songs come and go
+        self.duration = 0.0
+
+    def _changed(self):
+        if self.on_change:
+            self.on_change()
+
+    def _put(self, item):
+        super()._put(item)
+        self.duration += item.get('duration') or 0.0
+        self._changed()
+
+    def _get(self):
+        item = super()._get()
+        self._subtract(item)
+        return item
+
+    def _subtract(self, item):
+        """Takes a song that left the queue off the total duration"""
+
+        # snap back to zero when empty, so float error can't pile up
+        if self._queue:
+            self.duration -= item.get('duration') or 0.0
+        else:
+            self.duration = 0.0
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self._queue[i] for i in range(*item.indices(len(self._queue)))]
+        else:
+            return self._queue[item]
+
+    def __iter__(self):
+        return self._queue.__iter__()
+
+    def __len__(self):
+        return self.qsize()
+
+    def extend(self, items: list):
+        """Adds songs in one go, as many as fit; returns how many did"""
+
+        # only take what there's room for
+        if self.maxsize > 0:
+            items = items[:max(self.maxsize - self.qsize(), 0)]
+        if not items:
+            return 0
+
+        # what put_nowait does, once for the whole batch
+        self._queue.extend(items)
+        self.duration += sum(item.get('duration') or 0.0 for item in items)
+        self._unfinished_tasks += len(items)
+        self._finished.clear()
+        for _ in range(min(len(items), len(self._getters))):
+            self._wakeup_next(self._getters)
+        self._changed()
+        return len(items)
+
+    def clear(self):
+        self._queue.clear()
+        self.duration = 0.0
+        self._changed()
+
+    def shuffle(self):
+        random.shuffle(self._queue)
+        self._changed()
+
+    def remove(self, index: int):
+        """Removes the song at an index, returning it"""
+
+        item = self._queue[index]
+        del self._queue[index]
+        self._subtract(item)
+        self._changed()
+        return item
+
+    def move(self, index: int, to: int):
+        """Moves the song at an index to another, returning it"""
+
+        item = self._queue[index]
+        del self._queue[index]
+        self._queue.insert(to, item)
+        self._changed()
+        return item
+
+class PlayerSession():
+    """A single guild's player: its queue, voice client and prompt"""
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(guild={self.guild_id})"
+
+    def __init__(self, bot, guild_id: int, idle_timeout: float, on_destroy=None):
+
+        # constants
+        self.bot = bot
+        self.guild_id = guild_id
+        self.timeout = idle_timeout
+        self.on_destroy = on_destroy
+        self.last_active = time.monotonic()
+
+        # prompt variables
+        self.latest_prompt_message = None
+        self.latest_prompt_ctx = None
+        self.latest_prompt_data = None
+        self.latest_prompt_trace = None
+
+        # audio player stuff
+        self.audio_player_task = None
+        self.voice_client = None
+        self.player_loop = False
+        self.player_volume = 0.2
+
+        # song queue
+        self.current = None
+        self.start_next_song = asyncio.Event()
+        self.song_queue = SongQueue(
+            maxsize=env.queue_limit, on_change=self._on_queue_change
+        )
+
+        # next song's source, opened ahead of time, as a tuple of
+        # (queued entry, refreshed entry, source)
+        self.prefetched = None
+        self.prefetch_task = None
+
+    def touch(self):
+        """Marks the session as just used"""
+
+        self.last_active = time.monotonic()
+
+    def is_idle(self):
+        """Checks whether the session can be torn down"""
+
+        # connected sessions time out through their player instead
+        if self.voice_client is not None and self.voice_client.is_connected():
+            return False
+        return time.monotonic() - self.last_active > self.timeout
+
+    def start(self, voice_client: discord.VoiceClient):
+        """Starts the audio player on a voice client"""
+
+        self.voice_client = voice_client
+
+        # only ever run one player per guild
+        if self.audio_player_task is None or self.audio_player_task.done():
+            self.audio_player_task = self.bot.loop.create_task(
+                self._audio_player_task()
+            )
+
+    async def _audio_player_task(self):
+        """Main async task that handles playing songs"""
+
+        # print that the audio player thread has started
+        playerLogger.info(f"_audio_player_task started for {self.guild_id}!")
+
+        # put everything in a try block
+        try:
+
+            # loop forever
+            while True:
+
+                # clear the mutex
+                self.start_next_song.clear()
+
+                # if we're not set to loop, try getting next song
+                if not self.player_loop:
+
+                    # this will attempt to get a song from asyncio's queue
+                    # it will time out after 3 minutes, disconnecting
+                    # if no song is put in the quete
+                    try:
+                        async with timeout(self.timeout):
+                            self.current = await self.song_queue.get()
+                            playerLogger.info(
+                                "Got next song from queue! " + \
+                                f"{self.current['title']}"
+                            )
+                    except asyncio.TimeoutError:
+                        self.bot.loop.create_task(self.destroy())
+                        return
+
+                # pick up the trace of the play that queued this, if any
+                trace = self.current.pop('trace', None) or null_trace
+                trace.end("wait_player")
+
+                # use the prefetched source, if it's for this song
+                audio_source = self._take_prefetched(self.current)
+                if audio_source is not None:
+                    self.current, audio_source = audio_source
+                    trace.attrs["prefetched"] = True
+
+                # otherwise open it now
+                else:
+
+                    # refresh the entry, the file may have been moved or
+                    # removed from the library since it was queued
+                    with trace.span("lookup"):
+                        entry = await lookup_thread(self.current['id'])
+                    if entry is None:
+                        playerLogger.warning(
+                            "Skipping song no longer in library! " + \
+                            f"{self.current['path']}"
+                        )
+                        trace.finish("missing")
+
+                        # a looped song that's gone can't loop anymore,
+                        # move on to the queue instead of retrying it
+                        self.current = None
+                        self.player_loop = False
+                        continue
+                    self.current = entry
+
+                    # prep the song
+                    with trace.span("source"):
+                        audio_source = await self._make_source(self.current)
+
+                # race condition check
+                if self.voice_client.is_playing():
+                    playerLogger.critical(
+                        "Detected race condition: " + \
+                        "Started next song while already playing. " + \
+                        "Please ensure there is only one task running!"
+                    )
+
+                # play the song, finishing the trace once audio goes out
+                trace.begin("first_frame")
+                audio_source.on_first_frame = lambda: self._first_frame(trace)
+                self.voice_client.play(
+                    audio_source,
+                    after=self._play_next_song
+                )
+
+                # get the next song ready while this one plays
+                self._on_queue_change()
+
+                # wait for song to finish playing
+                # the callback should set this mutex,
+                # allowing this loop to continue
+                self.touch()
+                await self.start_next_song.wait()
+
+        # catch all exceptions
+        except BaseException as e:
+
+            # if it's a CancelledError, ignore it
+            if type(e) is asyncio.CancelledError:
+                playerLogger.info("_audio_player_task interrupted! Exiting...")
+                return
+
+            # else, its an actual error
+            playerLogger.critical(
+                "_audio_player_task error: " + \
+                type(e).__name__ + " - " + str(e)
+            )
+            raise
+
+    async def _make_source(self, entry: dict, prefetch: bool = False, start: float = 0.0):
+        """Gets an audio source for an entry, from the opus cache if we can"""
+
+        # the track's normalizing gain and the user's volume, as one factor
+        volume = self.player_volume * 10 ** ((entry['gain'] or 0.0) / 20)
+
+        # start partway in, if asked
+        before_options = f"-ss {start:.2f}" if start else None
+
+        # cached files are only ever passed straight through, which needs
+        # volume and gain to cancel out; decoding them to encode them again
+        # would lose quality for nothing, so other volumes play the
+        # original, and don't fill the cache either
+        passthrough = abs(volume - 1.0) < 0.001
+        cached = await to_thread(opus_cache.get)(entry) if passthrough else None
+        spawn_start = time.perf_counter()
+        if cached:
+            source = discord.FFmpegOpusAudio(
+                cached, codec='opus', before_options=before_options
+            )
+
+        # otherwise let ffmpeg do all the sample math, and the encoding
+        else:
+            source = discord.FFmpegOpusAudio(
+                entry['path'],
+                before_options=before_options,
+                options=f"-filter:a volume={volume:.4f}"
+            )
+        ffmpeg_spawn_seconds.observe(
+            time.perf_counter() - spawn_start, cached=str(bool(cached)).lower()
+        )
+
+        # cache it for next time it can be passed through
+        if passthrough and not cached:
+            opus_cache.fill_later(entry)
+
+        # read ahead too, if asked
+        if prefetch:
+            source = PrefetchedSource(source)
+        return TrackedSource(source, start)
+
+    async def set_volume(self, volume: float):
+        """Changes the volume, restarting the current song where it is"""
+
+        # the prefetched song has the old volume baked in
+        self.player_volume = volume
+        self._drop_prefetched()
+        self._on_queue_change()
+
+        # nothing playing
+        voice_client = self.voice_client
+        if voice_client is None or \
+            not (voice_client.is_playing() or voice_client.is_paused()):
+            return
+        old = voice_client.source
+        if not isinstance(old, TrackedSource):
+            return
+
+        # reopen the song where it is; if it ended in the meantime,
+        # the next one already has the new volume
+        source = await self._make_source(self.current, start=old.position)
+        if voice_client.source is not old:
+            _cleanup_later(source)
+            return
+
+        # swap it in; swapping resumes the player, so keep it paused
+        # if it was
+        paused = voice_client.is_paused()
+        voice_client.source = source
+        if paused:
+            voice_client.pause()
+        _cleanup_later(old)
+
+    #
+    # ===== [ Prefetching ] =====
+    #
+
+    def _on_queue_change(self):
+        """Keeps the prefetched source in line with the head of the queue"""
+
+        # drop the prefetched song if it's no longer up next
+        head = self.song_queue[0] if len(self.song_queue) else None
+        if self.prefetched is not None and self.prefetched[0] is not head:
+            self._drop_prefetched()
+        if self.prefetch_task is not None and self.prefetch_task.done():
+            self.prefetch_task = None
+
+        # prefetch the new head, if something's playing that it can follow
+        if head is not None and self.prefetched is None and \
+            self.prefetch_task is None and not self.player_loop and \
+            self.voice_client is not None and self.voice_client.is_playing():
+            self.prefetch_task = self.bot.loop.create_task(self._prefetch(head))
+
+    async def _prefetch(self, queued: dict):
+        """Opens and reads ahead a queued song"""
+
+        # refresh the entry, like the player would
+        entry = await lookup_thread(queued['id'])
+        if entry is None:
+            return
+
+        # open it, then make sure it's still wanted
+        source = await self._make_source(entry, prefetch=True)
+        head = self.song_queue[0] if len(self.song_queue) else None
+        if head is not queued:
+            _cleanup_later(source)
+            return
+
+        self.prefetched = (queued, entry, source)
+        playerLogger.info(f"Prefetched next song! {entry['title']}")
+
+    def _take_prefetched(self, queued: dict):
+        """Gets the prefetched (entry, source) for a song, if there is one"""
+
+        # nothing, or something else, was prefetched
+        if self.prefetched is None or self.prefetched[0] is not queued:
+            self._drop_prefetched()
+            return None
+        _, entry, source = self.prefetched
+        self.prefetched = None
+
+        return entry, source
+
+    def _drop_prefetched(self):
+        """Throws away the prefetched source, and any prefetch in flight"""
+
+        if self.prefetch_task is not None:
+            self.prefetch_task.cancel()
+            self.prefetch_task = None
+        if self.prefetched is not None:
+            _cleanup_later(self.prefetched[2])
+            self.prefetched = None
+
+    def _first_frame(self, trace):
+        """Called from the voice thread once a song's first frame is read"""
+
+        trace.end("first_frame")
+        trace.finish()
+
+    def _play_next_song(self, error: Optional[Exception]):
+        """Called when a song is done playing"""
+
+        # if there was an error
+        if error:
+            raise error
+
+        # set the next event; this gets called from the voice thread
+        self.bot.loop.call_soon_threadsafe(self.start_next_song.set)
+
+    async def destroy(self):
+        """Stops the audio player and tears the session down"""
+
+        # clear the queue
+        self.song_queue.clear()
+        self._drop_prefetched()
+
+        # stop the player task
+        if self.audio_player_task is not None:
+            self.audio_player_task.cancel()
+
+        # disconnect, if connected
+        if self.voice_client:
+            await self.voice_client.disconnect()
+            self.voice_client = None
+
+        # let the owner forget about us
+        if self.on_destroy:
+            self.on_destroy(self)
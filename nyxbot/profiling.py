@@ -0,0 +1,150 @@
+import os
+import time
+import heapq
+import random
+import cProfile
+import logging
+import reprlib
+import threading
+import contextlib
+
+from .env import env
+
+profileLogger = logging.getLogger('NyxBot.profile')
+
+# slow calls kept for >slowcmds, slowest first
+SLOW_HISTORY = 100
+
+# profiles kept on disk, oldest get deleted
+MAX_PROFILES = 50
+
+# short reprs of arguments, for logs
+_repr = reprlib.Repr()
+_repr.maxstring = 80
+_repr.maxother = 80
+
+def describe_args(args, kwargs):
+    """Formats call arguments for logging, skipping cogs and contexts"""
+
+    parts = [_repr.repr(arg) for arg in args if not hasattr(arg, 'bot')]
+    parts += [f"{key}={_repr.repr(value)}" for key, value in kwargs.items()]
+    return ", ".join(parts)
+
+class CallProfiler():
+    """Times calls, logging slow ones and profiling a sample of them"""
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.threshold}s, {self.sample_rate})"
+
+    def __init__(self, path: str, threshold: float, sample_rate: float):
+        self.path = path
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+
+        # only one cProfile can be running at once
+        self._profiling = False
+
+        # heap of the slowest calls, and per name (calls, total, max)
+        self._lock = threading.Lock()
+        self._slowest = []
+        self._stats = {}
+
+    @contextlib.contextmanager
+    def watch(self, name: str, args: str = ""):
+        """
+        Times the block inside, profiling it on a sample of calls; the
+        profile covers everything the event loop runs meanwhile
+        """
+
+        # profile a sample, if nothing else is being profiled
+        profile = None
+        if not self._profiling and random.random() < self.sample_rate:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+                self._profiling = True
+            except ValueError:
+                profile = None
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            if profile:
+                profile.disable()
+                self._profiling = False
+            self._record(name, args, elapsed, profile)
+
+    def _record(self, name: str, args: str, elapsed: float, profile):
+        """Records a finished call"""
+
+        # update per name stats
+        with self._lock:
+            calls, total, slowest = self._stats.get(name, (0, 0.0, 0.0))
+            self._stats[name] = (calls + 1, total + elapsed, max(slowest, elapsed))
+
+        # nothing else to do for fast calls
+        if elapsed < self.threshold:
+            return
+
+        # keep the profile, if we took one
+        dump = self._dump(name, profile) if profile else None
+        profileLogger.warning(
+            f"Slow call {name}({args}) took {elapsed:.2f}s" + \
+            (f", profile saved to {dump}" if dump else "")
+        )
+
+        # remember it, keeping only the slowest
+        with self._lock:
+            item = (elapsed, time.time(), name, args, dump)
+            if len(self._slowest) < SLOW_HISTORY:
+                heapq.heappush(self._slowest, item)
+            else:
+                heapq.heappushpop(self._slowest, item)
+
+    def _dump(self, name: str, profile: cProfile.Profile):
+        """Saves a profile to the config dir, pruning old ones"""
+
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            now = time.time()
+            path = os.path.join(
+                self.path,
+                f"{name.replace(' ', '_')}-" + \
+                    time.strftime('%Y%m%d-%H%M%S', time.localtime(now)) + \
+                    f".{int(now * 1000) % 1000:03d}.prof"
+            )
+            profile.dump_stats(path)
+
+            # delete the oldest past our limit
+            files = sorted(
+                (entry.stat().st_mtime, entry.path)
+                for entry in os.scandir(self.path) if entry.name.endswith(".prof")
+            )
+            for _, old in files[:-MAX_PROFILES]:
+                os.remove(old)
+            return path
+
+        except OSError as e:
+            profileLogger.error(f"Couldn't save profile of {name}: {e}")
+            return None
+
+    def slowest(self, count: int):
+        """Gets the slowest recorded calls, as (seconds, time, name, args, profile)"""
+
+        with self._lock:
+            return heapq.nlargest(count, self._slowest)
+
+    def stats(self, name: str):
+        """Gets (calls, mean, max) seconds for a name"""
+
+        with self._lock:
+            calls, total, slowest = self._stats.get(name, (0, 0.0, 0.0))
+        return calls, total / calls if calls else 0.0, slowest
+
+profiler = CallProfiler(
+    os.path.join(env.config_path, "profiles"),
+    env.slow_command_ms / 1000,
+    env.profile_sample_rate
+)
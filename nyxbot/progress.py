@@ -0,0 +1,169 @@
+import time
+import typing
+import threading
+import contextlib
+
+# least seconds between events, the indexer updates far more often
+PUBLISH_INTERVAL = 0.5
+
+class IndexStatus(typing.NamedTuple):
+    """Snapshot of what the indexer is up to"""
+
+    phase: str = "idle"
+    path: str = ""
+    dirs: int = 0
+    found: int = 0
+    tagged: int = 0
+    to_tag: int = 0
+    elapsed: float = 0.0
+    tag_elapsed: float = 0.0
+
+    @property
+    def running(self):
+        return self.phase != "idle"
+
+    @property
+    def rate(self):
+        """Files tagged per second"""
+
+        return self.tagged / self.tag_elapsed if self.tag_elapsed > 0 else 0.0
+
+    @property
+    def eta(self):
+        """Seconds left tagging at the current rate, or None if unknown"""
+
+        if not self.rate:
+            return None
+        return max(self.to_tag - self.tagged, 0) / self.rate
+
+class IndexProgress():
+    """
+    Progress of the indexer, updated from its thread and published to
+    subscribers on their event loops
+    """
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.snapshot().phase})"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = []
+        self._published = 0.0
+        self._reset()
+
+        # scans nest, only the outermost one starts and finishes a run
+        self._depth = 0
+
+    def _reset(self, path: str = ""):
+        self._phase = "idle"
+        self._path = path
+        self._dirs = 0
+        self._found = 0
+        self._tagged = 0
+        self._to_tag = 0
+        self._start = time.perf_counter()
+        self._tag_start = None
+        self._end = None
+
+    def snapshot(self):
+        """Gets the current status"""
+
+        with self._lock:
+            return self._snapshot()
+
+    def _snapshot(self):
+
+        # finished runs stay frozen at the time they ended
+        now = self._end or time.perf_counter()
+        return IndexStatus(
+            phase=self._phase,
+            path=self._path,
+            dirs=self._dirs,
+            found=self._found,
+            tagged=self._tagged,
+            to_tag=self._to_tag,
+            elapsed=now - self._start,
+            tag_elapsed=now - self._tag_start if self._tag_start else 0.0
+        )
+
+    def subscribe(self, loop, callback):
+        """
+        Calls back with an IndexStatus on the given loop whenever progress
+        is made, at most every PUBLISH_INTERVAL
+        Returns: Function that unsubscribes
+        """
+
+        subscriber = (loop, callback)
+        with self._lock:
+            self._subscribers.append(subscriber)
+
+        def unsubscribe():
+            with self._lock:
+                if subscriber in self._subscribers:
+                    self._subscribers.remove(subscriber)
+
+        return unsubscribe
+
+    def _publish(self, force: bool = False):
+        """Hands the status to subscribers; call with the lock held"""
+
+        # rate limit, unless the phase changed
+        now = time.perf_counter()
+        if not force and now - self._published < PUBLISH_INTERVAL:
+            return
+        self._published = now
+
+        # subscribers live on event loops, never call them from here
+        status = self._snapshot()
+        for loop, callback in self._subscribers:
+            try:
+                loop.call_soon_threadsafe(callback, status)
+            except RuntimeError:
+                pass
+
+    @contextlib.contextmanager
+    def run(self, path: str):
+        """Tracks a scan of path for the block inside"""
+
+        with self._lock:
+            self._depth += 1
+            if self._depth == 1:
+                self._reset(path)
+                self._phase = "scanning"
+                self._publish(force=True)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._phase = "idle"
+                    self._end = time.perf_counter()
+                    self._publish(force=True)
+
+    def walked(self, files: int):
+        """Records a directory listed, and the audio files found in it"""
+
+        with self._lock:
+            self._dirs += 1
+            self._found += files
+            self._publish()
+
+    def tagging(self, files: int):
+        """Records that a batch of files is about to be tagged"""
+
+        with self._lock:
+            self._to_tag += files
+            if self._tag_start is None:
+                self._tag_start = time.perf_counter()
+            self._phase = "tagging"
+            self._publish(force=True)
+
+    def tagged(self, files: int = 1):
+        """Records files tagged"""
+
+        with self._lock:
+            self._tagged += files
+            self._publish()
+
+index_progress = IndexProgress()
@@ -0,0 +1,278 @@
+import re
+import array
+import logging
+import threading
+import collections
+import numpy as np
+
+from .env import env
+
+searchLogger = logging.getLogger('NyxBot.search')
+
+# minimum similarity for a row to count as a near miss
+MIN_SIMILARITY = 0.3
+
+# posting list entries scanned to find candidates; the query's commonest
+# trigrams past this only get checked against the best candidates
+MAX_CANDIDATE_HITS = 100000
+
+# candidates rescored per result asked for
+CANDIDATES = 50
+
+def _trigrams(text: str):
+    """Gets the set of padded trigrams in a string"""
+
+    # pad each word like pg_trgm does, so word starts weigh more
+    grams = set()
+    for word in re.findall(r"\w+", text.lower()):
+        padded = f"  {word} "
+        for i in range(len(padded) - 2):
+            grams.add(padded[i:i + 3])
+    return grams
+
+class TrigramIndex():
+    """Resident trigram index used for typo tolerant searches"""
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(keys={len(self._key_rows)})"
+
+    def __init__(self):
+
+        # guards everything below, searches and adds come from
+        # different threads
+        self._lock = threading.Lock()
+
+        # trigram -> positions of the keys containing it
+        self._postings = {}
+
+        # key position -> library row id, and number of trigrams in key
+        self._key_rows = array.array('q')
+        self._key_sizes = array.array('H')
+
+    def __len__(self):
+        return len(self._key_rows)
+
+    def add(self, rows):
+        """Adds (id, title, artist) rows to the index"""
+
+        # local names, this loop runs for every track on startup
+        postings = self._postings
+        key_rows = self._key_rows
+        key_sizes = self._key_sizes
+
+        with self._lock:
+            for row_id, title, artist in rows:
+
+                # index the title on its own, and with the artist so
+                # "artist - title" style queries still line up
+                title = title or ""
+                for key in (title, f"{artist or ''} {title}"):
+
+                    # skip keys without any words in them
+                    grams = _trigrams(key)
+                    if not grams:
+                        continue
+
+                    # record the key, then add it to each posting list
+                    pos = len(key_rows)
+                    key_rows.append(row_id)
+                    key_sizes.append(min(len(grams), 0xFFFF))
+                    for gram in grams:
+                        try:
+                            postings[gram].append(pos)
+                        except KeyError:
+                            postings[gram] = array.array('i', (pos,))
+
+    def rebuild(self, rows):
+        """Replaces the index's contents with the given rows"""
+
+        # build a fresh index without blocking searches, then swap it in
+        fresh = TrigramIndex()
+        fresh.add(rows)
+        with self._lock:
+            self._postings = fresh._postings
+            self._key_rows = fresh._key_rows
+            self._key_sizes = fresh._key_sizes
+
+    def remove(self, row_ids):
+        """Drops rows from the index"""
+
+        # nothing to do
+        row_ids = np.fromiter(row_ids, dtype=np.int64)
+        if not len(row_ids) or not len(self._key_rows):
+            return
+
+        # tombstone the rows' keys in place; their postings stay behind
+        # until the next rebuild, but never score again
+        with self._lock:
+            self._tombstone(row_ids)
+
+    def _tombstone(self, row_ids):
+        """Marks every key belonging to the given rows as dead"""
+
+        key_rows = np.frombuffer(self._key_rows, dtype=np.int64)
+        key_rows[np.isin(key_rows, row_ids)] = -1
+
+    def search(self, query: str, limit: int):
+        """Returns ids of the rows most similar to the query, best first"""
+
+        # nothing to compare against
+        q_grams = _trigrams(query)
+        if not q_grams:
+            return []
+
+        # the numpy views below borrow our arrays' buffers, so they
+        # must be gone before anyone is allowed to append to them
+        with self._lock:
+            return self._score(q_grams, limit)
+
+    def _score(self, q_grams, limit: int):
+        """Scores the keys sharing the query's rarer trigrams in bulk"""
+
+        # gather the posting lists of the query's trigrams, rarest first
+        lists = sorted(
+            (
+                np.frombuffer(self._postings[gram], dtype=np.int32)
+                for gram in q_grams if gram in self._postings
+            ),
+            key=len
+        )
+        if not lists:
+            return []
+
+        # common trigrams like " th" match a good share of the library;
+        # find candidates with the rarer ones only, up to a budget
+        count = 1
+        total = len(lists[0])
+        while count < len(lists) and total + len(lists[count]) <= MAX_CANDIDATE_HITS:
+            total += len(lists[count])
+            count += 1
+        rare, common = lists[:count], lists[count:]
+
+        # count rare trigrams shared per key; sorting the hits and
+        # measuring the runs costs O(hits) rather than O(keys in the
+        # library). a lone list is already sorted and unique
+        if len(rare) == 1:
+            keys = rare[0]
+            shared = np.ones(len(keys), dtype=np.int64)
+        else:
+            hits = np.concatenate(rare)
+            hits.sort()
+            new_run = np.empty(len(hits), dtype=bool)
+            new_run[0] = True
+            np.not_equal(hits[1:], hits[:-1], out=new_run[1:])
+            starts = np.flatnonzero(new_run)
+            keys = hits[starts]
+            shared = np.diff(starts, append=len(hits))
+
+        # keep the keys sharing the most, shortest first, then count the
+        # common trigrams they share too; postings are sorted, so that's
+        # a binary search per trigram
+        sizes = np.frombuffer(self._key_sizes, dtype=np.uint16)[keys]
+
+        # drop keys that can't reach MIN_SIMILARITY even if they share
+        # every common trigram too
+        best = 2.0 * (shared + len(common)) / (sizes + len(q_grams))
+        reachable = np.flatnonzero(best >= MIN_SIMILARITY)
+        keys, shared, sizes = keys[reachable], shared[reachable], sizes[reachable]
+        if len(keys) > CANDIDATES * limit:
+            estimate = shared * 0x10000 - sizes
+            top = np.argpartition(-estimate, CANDIDATES * limit)[:CANDIDATES * limit]
+            top.sort()
+            keys, shared, sizes = keys[top], shared[top], sizes[top]
+        for postings in common:
+            found = np.searchsorted(postings, keys).clip(max=len(postings) - 1)
+            shared = shared + (postings[found] == keys)
+
+        # dice coefficient between the query and each candidate key,
+        # dropping weak matches and removed rows
+        scores = 2.0 * shared / (sizes + len(q_grams))
+        rows = np.frombuffer(self._key_rows, dtype=np.int64)[keys]
+        keep = (scores >= MIN_SIMILARITY) & (rows >= 0)
+        rows, scores = rows[keep], scores[keep]
+
+        # each row has at most two keys, so the best 2 * limit keys
+        # always cover the best `limit` rows
+        if len(rows) > 2 * limit:
+            top = np.argpartition(-scores, 2 * limit)[:2 * limit]
+            rows, scores = rows[top], scores[top]
+
+        # sort best first, then keep each row's best key only
+        rows = rows[np.argsort(-scores, kind='stable')]
+        _, first = np.unique(rows, return_index=True)
+        first.sort()
+
+        return rows[first][:limit].tolist()
+
+class SearchCache():
+    """LRU cache of search results, emptied whenever the library changes"""
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({len(self._results)}/{self.maxsize})"
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+
+        # normalized query -> results, least recently used first
+        self._lock = threading.Lock()
+        self._results = collections.OrderedDict()
+
+        # bumped on every library change; results computed against an
+        # older generation never get stored
+        self.generation = 0
+
+        # library generation the cache was last synced with
+        self._synced = None
+
+    def __len__(self):
+        return len(self._results)
+
+    @staticmethod
+    def normalize(query: str):
+        """Gets the cache key of a query, the same words search looks at"""
+
+        return " ".join(re.findall(r"\w+", query.lower()))
+
+    def get(self, key: str):
+        """Gets cached results, or None"""
+
+        with self._lock:
+            results = self._results.get(key)
+            if results is not None:
+                self._results.move_to_end(key)
+            return results
+
+    def put(self, key: str, generation: int, results: list):
+        """Caches results, if the library hasn't changed since they were found"""
+
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._results[key] = results
+            self._results.move_to_end(key)
+            while len(self._results) > self.maxsize:
+                self._results.popitem(last=False)
+
+    def sync(self, generation: int):
+        """
+        Drops everything if the library's generation moved since the last
+        sync, catching changes made by other processes
+        """
+
+        with self._lock:
+            if generation == self._synced:
+                return
+            self._synced = generation
+        self.invalidate()
+
+    def invalidate(self):
+        """Drops everything, the library changed"""
+
+        with self._lock:
+            self.generation += 1
+            self._results.clear()
+
+search_index = TrigramIndex()
+search_cache = SearchCache(env.search_cache_size)
@@ -0,0 +1,152 @@
+import time
+import signal
+import logging
+import multiprocessing
+from multiprocessing.connection import wait
+
+from .env import env
+
+shardLogger = logging.getLogger('NyxBot.shards')
+
+# seconds between initial worker starts, so shards don't all identify
+# with discord at once
+START_DELAY = 5
+
+# restart backoff bounds, in seconds
+MIN_BACKOFF = 5
+MAX_BACKOFF = 300
+
+# workers that stayed up this long get their backoff reset
+HEALTHY_UPTIME = 600
+
+def run_worker(index: int, shard_ids: list, shard_count: int):
+    """Entry point of a shard worker process"""
+
+    # imported here, so the supervisor never builds a bot of its own
+    from .util.log import setup_logging
+    from .db import load_search_index
+    from .discord import create_bot
+
+    # set up logging
+    setup_logging()
+    shardLogger.info(f"Worker {index} starting shards {shard_ids}")
+
+    # only the first worker keeps the library up to date; the rest
+    # just read from it
+    env.run_indexer = index == 0
+
+    # each worker serves its own metrics, on consecutive ports
+    if env.metrics_port:
+        env.metrics_port += index
+
+    # load search index
+    load_search_index()
+
+    # start bot
+    create_bot(shard_ids=shard_ids, shard_count=shard_count).run(env.token)
+
+class ShardSupervisor():
+    """Runs the bot's shards across worker processes, restarting them"""
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}{self.assignments}"
+
+    def __init__(self, shard_count: int, processes: int):
+
+        # spawn, so workers start clean rather than inheriting our state
+        self.mp = multiprocessing.get_context('spawn')
+
+        # deal shards out round robin
+        processes = min(processes, shard_count)
+        self.shard_count = shard_count
+        self.assignments = [
+            list(range(i, shard_count, processes)) for i in range(processes)
+        ]
+
+        # worker index -> process, start time, backoff and restart time
+        self.workers = {}
+        self.started = {}
+        self.backoff = {}
+        self.restart_at = {}
+        self.stopping = False
+
+    def _start(self, index: int):
+        """Starts a worker"""
+
+        proc = self.mp.Process(
+            target=run_worker,
+            args=(index, self.assignments[index], self.shard_count),
+            name=f"NyxBot-worker-{index}"
+        )
+        proc.start()
+        self.workers[index] = proc
+        self.started[index] = time.monotonic()
+        shardLogger.info(
+            f"Started worker {index} (pid {proc.pid}) " + \
+            f"with shards {self.assignments[index]}"
+        )
+
+    def _reap(self, index: int):
+        """Handles a worker that exited, scheduling its restart"""
+
+        proc = self.workers.pop(index)
+        proc.join()
+        uptime = time.monotonic() - self.started[index]
+        shardLogger.error(
+            f"Worker {index} exited with code {proc.exitcode} " + \
+            f"after {uptime:.0f}s"
+        )
+
+        # back off harder the faster it keeps dying
+        if uptime > HEALTHY_UPTIME:
+            self.backoff[index] = MIN_BACKOFF
+        else:
+            self.backoff[index] = min(
+                self.backoff.get(index, MIN_BACKOFF / 2) * 2, MAX_BACKOFF
+            )
+        self.restart_at[index] = time.monotonic() + self.backoff[index]
+        shardLogger.warning(
+            f"Restarting worker {index} in {self.backoff[index]:.0f}s"
+        )
+
+    def _stop(self, signum, frame):
+        """Signal handler: shut everything down"""
+
+        shardLogger.warning(f"Got signal {signum}, stopping workers...")
+        self.stopping = True
+
+    def run(self):
+        """Starts every worker and babysits them until told to stop"""
+
+        # stop on the usual signals
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        # stagger initial starts
+        now = time.monotonic()
+        for index in range(len(self.assignments)):
+            self.restart_at[index] = now + index * START_DELAY
+
+        # loop until told to stop
+        while not self.stopping:
+
+            # start anything that's due
+            now = time.monotonic()
+            for index, due in list(self.restart_at.items()):
+                if due <= now:
+                    del self.restart_at[index]
+                    self._start(index)
+
+            # wait for a worker to exit, waking up now and then to
+            # start workers and check if we've been told to stop
+            sentinels = {proc.sentinel: i for i, proc in self.workers.items()}
+            for sentinel in wait(list(sentinels), timeout=1):
+                self._reap(sentinels[sentinel])
+
+        # ask workers to stop, then make them
+        for proc in self.workers.values():
+            proc.terminate()
+        for proc in self.workers.values():
+            proc.join(timeout=30)
+            if proc.is_alive():
+                proc.kill()
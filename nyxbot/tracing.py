@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+import contextlib
+import collections
+
+# traces are logged here as one json object per line; see setup_logging
+traceLogger = logging.getLogger('NyxBot.trace')
+
+# finished traces kept in memory for summaries
+TRACE_HISTORY = 500
+
+# spans spent waiting on users rather than on us
+WAIT_SPANS = ("prompt",)
+
+class Trace():
+    """Timeline of a single request, split into named spans"""
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.name}, {self.id})"
+
+    def __init__(self, name: str, **attrs):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.attrs = attrs
+        self.started = time.time()
+        self._start = time.perf_counter()
+
+        # finished spans, and the start of ones still open
+        self.spans = []
+        self._open = {}
+
+        # set once finished
+        self.status = None
+        self.duration = None
+
+    def _elapsed(self):
+        return time.perf_counter() - self._start
+
+    def begin(self, name: str):
+        """Opens a span, for spans that end somewhere else"""
+
+        self._open[name] = self._elapsed()
+
+    def end(self, name: str):
+        """Closes a span opened with begin"""
+
+        start = self._open.pop(name, None)
+        if start is not None:
+            self.spans.append({
+                "name": name,
+                "start": start,
+                "duration": self._elapsed() - start,
+            })
+
+    @contextlib.contextmanager
+    def span(self, name: str):
+        """Records the block inside as a span"""
+
+        self.begin(name)
+        try:
+            yield
+        finally:
+            self.end(name)
+
+    @property
+    def active(self):
+        """Time taken, minus time spent waiting on users"""
+
+        return self.duration - sum(
+            span["duration"] for span in self.spans if span["name"] in WAIT_SPANS
+        )
+
+    def finish(self, status: str = "ok", **attrs):
+        """Finishes the trace, logging and storing it; only the first call counts"""
+
+        if self.status is not None:
+            return
+        self.status = status
+        self.duration = self._elapsed()
+        self.attrs.update(attrs)
+
+        traces.add(self)
+        traceLogger.info(json.dumps(self.to_dict()))
+
+    def to_dict(self):
+        """Gets the trace as a json friendly dict"""
+
+        return {
+            "trace": self.id,
+            "name": self.name,
+            "pid": os.getpid(),
+            "started": self.started,
+            "status": self.status,
+            "duration": self.duration,
+            "attrs": self.attrs,
+            "spans": self.spans,
+        }
+
+class NullTrace(Trace):
+    """Trace that records nothing, for requests that aren't traced"""
+
+    def begin(self, name: str):
+        pass
+
+    def end(self, name: str):
+        pass
+
+    def finish(self, status: str = "ok", **attrs):
+        pass
+
+class TraceStore():
+    """Bounded history of finished traces"""
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({len(self._traces)})"
+
+    def __init__(self, maxlen: int):
+        self._lock = threading.Lock()
+        self._traces = collections.deque(maxlen=maxlen)
+
+    def add(self, trace: Trace):
+        """Stores a finished trace; they finish on the voice thread too"""
+
+        with self._lock:
+            self._traces.append(trace)
+
+    def finished(self, name: str, status: str = "ok"):
+        """Gets stored traces with a given name and status"""
+
+        with self._lock:
+            return [
+                trace for trace in self._traces
+                if trace.name == name and trace.status == status
+            ]
+
+traces = TraceStore(TRACE_HISTORY)
+null_trace = NullTrace("null")
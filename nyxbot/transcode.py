@@ -0,0 +1,174 @@
+import os
+import json
+import math
+import logging
+import threading
+import subprocess
+
+from .env import env
+from .util.threading import InstrumentedExecutor
+
+transcodeLogger = logging.getLogger('NyxBot.transcode')
+
+# most a track's loudness gets boosted, in dB, so quiet intros and
+# noise don't get blown up
+MAX_GAIN = 12.0
+
+# highest true peak a boost may push a track to, in dBTP
+MAX_PEAK = -1.0
+
+# bounded pool for ffmpeg transcodes, so they can't pile up
+transcode_executor = InstrumentedExecutor('transcode', env.transcode_workers)
+
+def measure_gain(path: str):
+    """
+    Measures a file's EBU R128 loudness with ffmpeg
+    Returns: Gain in dB bringing it to the target loudness, None on failure
+    """
+
+    # loudnorm's analysis prints its stats as json at the end of stderr
+    try:
+        proc = subprocess.run(
+            [
+                'ffmpeg', '-nostdin', '-hide_banner', '-nostats',
+                '-i', path, '-vn',
+                '-af', 'loudnorm=print_format=json', '-f', 'null', '-'
+            ],
+            check=True,
+            capture_output=True
+        )
+        stats = json.loads(proc.stderr[proc.stderr.rindex(b'{'):])
+        loudness = float(stats['input_i'])
+        peak = float(stats['input_tp'])
+
+    # leave it unmeasured
+    except (OSError, ValueError, KeyError, subprocess.CalledProcessError) as e:
+        transcodeLogger.error(f"Couldn't measure loudness of {path}: {e}")
+        return None
+
+    # silence measures as -inf, leave it be
+    if not math.isfinite(loudness):
+        return 0.0
+
+    # bring it to the target, without clipping or boosting too far
+    return min(env.loudness_target - loudness, MAX_PEAK - peak, MAX_GAIN)
+
+class OpusCache():
+    """Size bounded LRU cache of library tracks transcoded to Opus"""
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.path}, {self.max_bytes})"
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+
+        # keys currently being transcoded, so we only do each once
+        self._lock = threading.Lock()
+        self._pending = set()
+
+        # make sure the cache dir exists
+        if self.enabled:
+            os.makedirs(self.path, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _key(self, entry: dict):
+        """Gets an entry's file name; retagged or replaced files get new ones"""
+
+        return f"{entry['id']}-{entry['mtime'] or 0}.opus"
+
+    def get(self, entry: dict):
+        """Gets the cached file for a library entry, if there is one"""
+
+        if not self.enabled:
+            return None
+
+        # touch it on the way out, mtimes are our LRU clock
+        path = os.path.join(self.path, self._key(entry))
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def fill_later(self, entry: dict):
+        """Transcodes an entry into the cache in the background"""
+
+        if not self.enabled:
+            return
+
+        # skip it if it's already on its way
+        key = self._key(entry)
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+
+        transcode_executor.submit(self._fill, key, entry['path'])
+
+    def _fill(self, key: str, source: str):
+        """Transcodes a file into the cache; runs on the transcode pool"""
+
+        # write to a temp file first, so players never see half a file
+        path = os.path.join(self.path, key)
+        tmp = path + ".tmp"
+        try:
+            subprocess.run(
+                [
+                    'ffmpeg', '-nostdin', '-loglevel', 'error', '-y',
+                    '-i', source, '-vn', '-map_metadata', '-1',
+                    '-c:a', 'libopus', '-b:a', f"{env.opus_bitrate}k",
+                    '-ar', '48000', '-ac', '2', '-f', 'ogg', tmp
+                ],
+                check=True,
+                capture_output=True
+            )
+            os.replace(tmp, path)
+            transcodeLogger.info(f"Cached {source} as {key}")
+
+        # leave the file uncached, it'll just play the slow way
+        except (OSError, subprocess.CalledProcessError) as e:
+            transcodeLogger.error(
+                f"Couldn't transcode {source}: " + \
+                (e.stderr.decode(errors='replace').strip()
+                    if isinstance(e, subprocess.CalledProcessError) else str(e))
+            )
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+        # whatever happens, we're done with it
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+        # make room, if needed
+        self.evict()
+
+    def evict(self):
+        """Deletes least recently used files until we fit in our budget"""
+
+        # get every finished file, with its size and last use
+        files = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(".opus"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        # delete the oldest until we're under budget
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+
+opus_cache = OpusCache(
+    os.path.join(env.config_path, "opus_cache"),
+    env.opus_cache_size * 1024 * 1024
+)
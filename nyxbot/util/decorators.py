@@ -2,6 +2,7 @@ import discord
 import functools
 
 from ..discord import EmbedColors
+from ..profiling import profiler, describe_args
 
 def ensure_bot_in_channel(func):
     """Decorator to ensure bot is within a channel"""
@@ -20,5 +21,18 @@ def ensure_bot_in_channel(func):
         # return result of normal coroutine
         return await func(self, ctx, *args, **kwargs)
 
+    # return wrapped function
+    return wrapper
+
+def profile_slow(func):
+    """Decorator to time a coroutine, logging and profiling slow calls"""
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+
+        # time it, profiling it if it's sampled
+        with profiler.watch(func.__qualname__, describe_args(args, kwargs)):
+            return await func(*args, **kwargs)
+
     # return wrapped function
     return wrapper
\ No newline at end of file
@@ -0,0 +1,8 @@
+def format_duration(seconds: float):
+    """Formats seconds as h:mm:ss, or m:ss"""
+
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
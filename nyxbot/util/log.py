@@ -0,0 +1,35 @@
+import os
+import sys
+import logging
+
+from ..env import env
+
+def setup_logging():
+    """Sets up logging to the config dir and console"""
+
+    # set up logging
+    if not os.path.exists(env.config_path):
+        os.makedirs(env.config_path)
+
+    # configure logging basics for file
+    logging.basicConfig(
+        format="%(asctime)s %(name)-20s %(levelname)s: %(message)s",
+        datefmt="%m/%d/%Y %I:%M:%S %p",
+        level=logging.INFO,
+        filename=os.path.join(env.config_path, "music.log")
+    )
+
+    # configure logging basics for console
+    logging.getLogger().addHandler(logging.StreamHandler())
+    console = logging.StreamHandler(sys.stdout)
+    console.setLevel(logging.WARNING)
+
+    # add console handler to logger
+    logging.getLogger().addHandler(console)
+
+    # traces get their own file, one json object per line
+    traces = logging.FileHandler(os.path.join(env.config_path, "trace.log"))
+    traces.setFormatter(logging.Formatter("%(message)s"))
+    traceLogger = logging.getLogger('NyxBot.trace')
+    traceLogger.addHandler(traces)
+    traceLogger.propagate = False
@@ -1,6 +1,163 @@
+import os
+import time
 import functools
 import typing
 import asyncio
+import threading
+import concurrent.futures
+
+from ..metrics import executor_queued, executor_active, executor_wait_seconds
+
+# every named executor, for metrics and shutdown
+executors = {}
+
+class InstrumentedExecutor(concurrent.futures.ThreadPoolExecutor):
+    """Named thread pool, keeping count of how backed up it is"""
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.name}, {self.max_workers})"
+
+    def __init__(self, name: str, max_workers: int):
+        super().__init__(
+            max_workers=max_workers,
+            thread_name_prefix=f'NyxBot.{name}'
+        )
+        self.name = name
+        self.max_workers = max_workers
+
+        # calls waiting for a thread, and calls running on one
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+
+        executors[name] = self
+
+    def submit(self, fn, *args, **kwargs):
+        submitted = time.perf_counter()
+
+        def run():
+
+            # note how long it waited, then that it's running
+            executor_wait_seconds.observe(
+                time.perf_counter() - submitted, executor=self.name
+            )
+            with self._lock:
+                self.queued -= 1
+                self.active += 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.active -= 1
+
+        with self._lock:
+            self.queued += 1
+        try:
+            future = super().submit(run)
+        except RuntimeError:
+            with self._lock:
+                self.queued -= 1
+            raise
+
+        # calls cancelled before a thread took them never run at all,
+        # like when whoever awaited them gave up, or on shutdown
+        future.add_done_callback(self._cancelled)
+        return future
+
+    def _cancelled(self, future):
+        """Takes a call off the queued count if it got cancelled"""
+
+        if future.cancelled():
+            with self._lock:
+                self.queued -= 1
+
+def _timed_call(fn, *args, **kwargs):
+    """Runs fn in a worker process, noting when it started"""
+
+    # wall clock, the parent's perf_counter means nothing in here
+    return time.time(), fn(*args, **kwargs)
+
+class InstrumentedProcessExecutor(concurrent.futures.ProcessPoolExecutor):
+    """
+    Named process pool, keeping count of how backed up it is; calls must
+    pickle, so they're timed in the worker and handed back with the result
+    """
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.name}, {self.max_workers})"
+
+    def __init__(self, name: str, max_workers: int):
+        super().__init__(max_workers=max_workers)
+        self.name = name
+        self.max_workers = max_workers
+
+        # calls handed to the pool and not finished yet; the pool marks
+        # them running once a worker can take them
+        self._lock = threading.Lock()
+        self._pending = set()
+
+        executors[name] = self
+
+    @property
+    def queued(self):
+        with self._lock:
+            return sum(not future.running() for future in self._pending)
+
+    @property
+    def active(self):
+        with self._lock:
+            return sum(future.running() for future in self._pending)
+
+    def submit(self, fn, *args, **kwargs):
+        submitted = time.time()
+        inner = super().submit(_timed_call, fn, *args, **kwargs)
+        with self._lock:
+            self._pending.add(inner)
+
+        # callers get the plain result, the start time is ours
+        outer = concurrent.futures.Future()
+
+        def finish(inner):
+            with self._lock:
+                self._pending.discard(inner)
+            if outer.cancelled():
+                return
+            if inner.cancelled():
+                outer.cancel()
+            elif inner.exception() is not None:
+                outer.set_exception(inner.exception())
+            else:
+                started, result = inner.result()
+                executor_wait_seconds.observe(
+                    max(started - submitted, 0.0), executor=self.name
+                )
+                outer.set_result(result)
+
+        # map cancels what's left if its caller gives up
+        outer.add_done_callback(lambda outer: outer.cancelled() and inner.cancel())
+        inner.add_done_callback(finish)
+        return outer
+
+def shutdown_executors():
+    """Stops every named executor, dropping calls that haven't started"""
+
+    # running calls finish on their own, don't block the loop on them
+    for executor in executors.values():
+        executor.shutdown(wait=False, cancel_futures=True)
+
+# report every executor's load when scraped
+executor_queued.set_function(
+    lambda: {(name,): ex.queued for name, ex in executors.items()}
+)
+executor_active.set_function(
+    lambda: {(name,): ex.active for name, ex in executors.items()}
+)
+
+# odd jobs that don't have an executor of their own; sized like the
+# loop's default executor, which this replaces
+blocking_executor = InstrumentedExecutor(
+    'blocking', min(32, (os.cpu_count() or 1) + 4)
+)
 
 def to_thread(func: typing.Callable) -> typing.Coroutine:
 
@@ -11,14 +168,32 @@ def to_thread(func: typing.Callable) -> typing.Coroutine:
 
         wrapped = functools.partial(func, *args, **kwargs)
 
-        return await loop.run_in_executor(None, wrapped)
+        return await loop.run_in_executor(blocking_executor, wrapped)
     
     return wrapper
 
+def run_in(executor: concurrent.futures.Executor) -> typing.Callable:
+    """Like to_thread, but runs on the given executor"""
+
+    def decorator(func: typing.Callable) -> typing.Coroutine:
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+
+            loop = asyncio.get_event_loop()
+
+            wrapped = functools.partial(func, *args, **kwargs)
+
+            return await loop.run_in_executor(executor, wrapped)
+
+        return wrapper
+
+    return decorator
+
 async def run_blocking(bot, blocking_func: typing.Callable, *args, **kwargs) -> typing.Any:
     """Runs a blocking function in a non-blocking way"""
 
     # `run_in_executor` doesn't support kwargs, `functools.partial` does
     func = functools.partial(blocking_func, *args, **kwargs)
 
-    return await bot.loop.run_in_executor(None, func)
\ No newline at end of file
+    return await bot.loop.run_in_executor(blocking_executor, func)
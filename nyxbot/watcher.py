@@ -0,0 +1,97 @@
+import os
+import time
+import logging
+import threading
+from watchdog.observers import Observer
+from watchdog.events import FileSystemEventHandler, DirModifiedEvent
+
+from .db import AUDIO_EXTENSIONS, _skip_entry
+
+watcherLogger = logging.getLogger('NyxBot.watcher')
+
+class LibraryWatcher(FileSystemEventHandler):
+    """Collects the paths touched under the music library"""
+
+    def __init__(self, path: str, debounce: float):
+        super().__init__()
+
+        # settings
+        self.path = path
+        self.debounce = debounce
+
+        # paths touched since the last drain, and when the last one was
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._last_event = 0.0
+
+        # inotify backed observer on linux
+        self._observer = Observer()
+        self._observer.schedule(self, path, recursive=True)
+
+    def start(self):
+        """Starts watching the library"""
+
+        self._observer.start()
+        watcherLogger.info(f"Watching {self.path} for changes")
+
+    def stop(self):
+        """Stops watching the library"""
+
+        self._observer.stop()
+        self._observer.join()
+
+    def on_any_event(self, event):
+        """Event: something changed under the library"""
+
+        # directory mtimes change whenever their contents do; the
+        # events for the contents themselves are what we care about
+        if isinstance(event, DirModifiedEvent):
+            return
+
+        # moves touch both ends
+        paths = [event.src_path, getattr(event, 'dest_path', None)]
+        paths = [p for p in paths if p and self._is_relevant(p, event)]
+        if not paths:
+            return
+
+        # record them
+        with self._lock:
+            self._pending.update(paths)
+            self._last_event = time.monotonic()
+
+    def _is_relevant(self, path: str, event):
+        """Checks whether an event's path could affect the library"""
+
+        # skip junk anywhere along the path
+        if any(_skip_entry(part) for part in path.split(os.sep)):
+            return False
+
+        # directories always matter, files only if they're audio
+        return event.is_directory or path.lower().endswith(AUDIO_EXTENSIONS)
+
+    def drain(self):
+        """
+        Takes the touched paths once events have been quiet for the
+        debounce period, coalescing paths inside touched directories
+        Returns: Set of paths, empty if there's nothing ready yet
+        """
+
+        # wait for things to settle
+        with self._lock:
+            if not self._pending or \
+                time.monotonic() - self._last_event < self.debounce:
+                return set()
+            pending, self._pending = self._pending, set()
+
+        # drop anything already covered by a touched parent
+        return set(p for p in pending if not self._has_parent_in(p, pending))
+
+    def _has_parent_in(self, path: str, paths: set):
+        """Checks whether any ancestor of a path is in a set"""
+
+        parent = os.path.dirname(path)
+        while parent and parent != path:
+            if parent in paths:
+                return True
+            path, parent = parent, os.path.dirname(parent)
+        return False